@@ -0,0 +1,218 @@
+"""Offline benchmarks for the mail check pipeline.
+
+Starts a stub authoritative DNS server and a fake SMTP server on localhost,
+points the check modules at them and reports throughput, latency
+percentiles and upstream query counts. No network access is needed:
+
+    python benchmarks/bench.py --domains 500 --concurrency 100
+"""
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "scripts"))
+
+import resolver  # noqa: E402
+import mail_echo_check  # noqa: E402
+from spf_graph import graph  # noqa: E402
+from bulk import run_bulk  # noqa: E402
+from main import check_domain_async  # noqa: E402
+from spf_check import analyze_spf_lookups_async  # noqa: E402
+from dkim_check import check_dkim_async, DEFAULT_SELECTORS  # noqa: E402
+from stubs import Zone, StubDNSServer, StubSMTPServer  # noqa: E402
+
+WORKLOADS = ("single", "bulk", "spf", "dkim", "smtp")
+# Sized like a 4096-bit RSA key, so the answer exceeds 512 bytes
+DKIM_KEY = "MIICIjANBgkqhkiG9w0BAQEFAAOCAg8AMIICCgKCAgEA" + "x" * 686 + "IDAQAB"
+
+
+def _txt_strings(text):
+    # A TXT character-string holds at most 255 bytes
+    return [text[i:i + 255] for i in range(0, len(text), 255)]
+
+
+def build_zone(domains, providers, depth, slow_latency):
+    """Generate customer domains sharing a few providers' SPF trees and MX hosts.
+
+    Every 20th domain is NXDOMAIN, every 20th+1 answers with injected latency
+    and every 20th+2 never answers at all.
+    """
+    zone = Zone()
+    for p in range(providers):
+        provider = f"prov{p}.bench"
+        # Two nodes per level, each including both nodes of the next level,
+        # so the include graph is a chain of diamonds
+        for level in range(depth):
+            for node in range(2):
+                name = f"_spf{level}-{node}.{provider}"
+                if level == depth - 1:
+                    terms = [f"ip4:198.{p}.{node}.0/24", f"ip6:2001:db8:{p}:{node}::/64"]
+                else:
+                    terms = [f"include:_spf{level + 1}-{n}.{provider}" for n in range(2)]
+                zone.add(name, 'TXT', f'"v=spf1 {" ".join(terms)} ~all"')
+        zone.add(f"_spf.{provider}", 'TXT', f'"v=spf1 include:_spf0-0.{provider} include:_spf0-1.{provider} ~all"')
+        for mx in ("mx1", "mx2"):
+            zone.add(f"{mx}.{provider}", 'A', "127.0.0.1")
+
+    names = []
+    for i in range(domains):
+        domain = f"d{i}.bench"
+        names.append(domain)
+        kind = i % 20
+        if kind == 0:
+            continue
+        if kind == 1:
+            zone.delay(domain, slow_latency)
+        if kind == 2:
+            zone.blackhole(domain)
+
+        provider = f"prov{i % providers}.bench"
+        zone.add(domain, 'TXT', f'"v=spf1 include:_spf.{provider} ip4:192.0.2.{i % 250}/32 mx -all"')
+        zone.add(domain, 'MX', f"10 mx1.{provider}.", f"20 mx2.{provider}.")
+        if i % 3:
+            zone.add(f"_dmarc.{domain}", 'TXT', f'"v=DMARC1; p=quarantine; rua=mailto:dmarc@{domain}"')
+        selector = DEFAULT_SELECTORS[i % len(DEFAULT_SELECTORS)]
+        # Without EDNS, answers over 512 bytes make the resolver retry over TCP
+        zone.add(f"{selector}._domainkey.{domain}", 'TXT',
+                 " ".join(f'"{chunk}"' for chunk in _txt_strings(f"v=DKIM1; k=rsa; p={DKIM_KEY}")))
+    return zone, names
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class _Null(io.TextIOBase):
+    def write(self, s):
+        return len(s)
+
+
+def _reset_caches():
+    resolver.clear_cache()
+    graph.clear()
+    mail_echo_check.clear_smtp_cache()
+
+
+async def _timed(samples, coro):
+    started = time.perf_counter()
+    result = await coro
+    samples.append((time.perf_counter() - started) * 1000)
+    return result
+
+
+async def _sequential(names, make_coro, samples):
+    for name in names:
+        await _timed(samples, make_coro(name))
+
+
+async def _bulk(names, concurrency, deadline, samples):
+    async def check(domain):
+        return await _timed(samples, check_domain_async(domain, deadline))
+    await run_bulk(io.StringIO("\n".join(names)), check, concurrency, out=_Null())
+
+
+def _run_workload(name, names, args, dns_server, smtp_server):
+    healthy = [d for i, d in enumerate(names) if i % 20 > 2]
+    samples = []
+    if name == "single":
+        # One domain at a time, as the API handles a lone request
+        runner = _sequential(names[:args.sample], lambda d: check_domain_async(d, args.deadline), samples)
+    elif name == "bulk":
+        runner = _bulk(names, args.concurrency, args.deadline, samples)
+    elif name == "spf":
+        records = {d: f"v=spf1 include:_spf.prov{i % args.providers}.bench mx -all"
+                   for i, d in enumerate(healthy)}
+        runner = _sequential(healthy, lambda d: analyze_spf_lookups_async(records[d], d), samples)
+    elif name == "dkim":
+        runner = _sequential(healthy[:args.sample], lambda d: check_dkim_async(d, deadline=args.deadline), samples)
+    else:
+        runner = _sequential(
+            healthy[:args.sample],
+            lambda d: mail_echo_check.check_mail_echo_with_smtp_async(d, args.deadline), samples)
+
+    _reset_caches()
+    dns_server.reset_counters()
+    smtp_sessions = smtp_server.sessions
+    started = time.perf_counter()
+    asyncio.run(runner)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "workload": name,
+        "operations": len(samples),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(samples, 50), 2),
+        "p95_ms": round(percentile(samples, 95), 2),
+        "p99_ms": round(percentile(samples, 99), 2),
+        "dns_queries": dns_server.total_queries,
+        "dns_queries_by_type": dict(dns_server.queries),
+        "dns_tcp_connections": dns_server.tcp_connections,
+        "smtp_sessions": smtp_server.sessions - smtp_sessions,
+        "dns_cache": resolver.cache_stats()
+    }
+
+
+def _print_table(results):
+    header = (f"{'workload':<8} {'ops':>6} {'ops/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+              f"{'dns q':>7} {'tcp':>5} {'smtp':>5}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['workload']:<8} {r['operations']:>6} {r['throughput']:>8} {r['p50_ms']:>9} "
+              f"{r['p95_ms']:>9} {r['p99_ms']:>9} {r['dns_queries']:>7} {r['dns_tcp_connections']:>5} "
+              f"{r['smtp_sessions']:>5}")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Offline mail check benchmarks")
+    parser.add_argument("--domains", type=int, default=200, help="customer domains to generate")
+    parser.add_argument("--providers", type=int, default=5, help="mail providers shared by the domains")
+    parser.add_argument("--depth", type=int, default=3, help="levels in each provider's SPF include tree")
+    parser.add_argument("--sample", type=int, default=50, help="domains used by sequential workloads")
+    parser.add_argument("--concurrency", type=int, default=50, help="in-flight checks for the bulk workload")
+    parser.add_argument("--deadline", type=float, default=2.0, help="time budget per domain check")
+    parser.add_argument("--lifetime", type=float, default=1.0, help="DNS query lifetime in seconds")
+    parser.add_argument("--latency", type=float, default=0.05, help="injected latency for slow domains")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="comma-separated workloads to run")
+    parser.add_argument("--transport", action="store_true",
+                        help="resolve through the pooled upstream transport instead of dnspython")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    zone, names = build_zone(args.domains, args.providers, args.depth, args.latency)
+
+    dns_server = StubDNSServer(zone).start()
+    smtp_server = StubSMTPServer().start()
+    resolver.configure(nameservers=[dns_server.host], port=dns_server.port)
+    if args.transport:
+        resolver.configure(upstreams=[f"{dns_server.host}:{dns_server.port}"])
+    resolver.DNS_LIFETIME = args.lifetime
+    mail_echo_check.SMTP_PORT = smtp_server.port
+
+    try:
+        results = [_run_workload(w.strip(), names, args, dns_server, smtp_server)
+                   for w in args.workloads.split(",") if w.strip()]
+    finally:
+        dns_server.stop()
+        smtp_server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+
+
+if __name__ == "__main__":
+    main()
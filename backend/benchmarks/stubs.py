@@ -0,0 +1,294 @@
+import socket
+import asyncio
+import threading
+import multiprocessing
+from collections import Counter
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+SOA_TEXT = "ns.bench. hostmaster.bench. 1 3600 600 86400 300"
+
+
+class Zone:
+    """Records served by the stub, plus injected latency, dropped names and SERVFAILs"""
+
+    def __init__(self, origin="bench."):
+        self.origin = origin
+        self.records = {}
+        self.names = set()
+        self.latency = {}
+        self.drop = set()
+        self.failing = set()
+        self._parsed = {}
+
+    def add(self, name, rdtype, *rdatas, ttl=300):
+        name = name.lower().rstrip('.') + '.'
+        self.records.setdefault((name, rdtype), (ttl, []))[1].extend(rdatas)
+        self._parsed.pop((name, rdtype), None)
+        # Every ancestor exists as an empty non-terminal, so it answers NODATA
+        labels = name.split('.')
+        for i in range(len(labels) - 1):
+            self.names.add('.'.join(labels[i:]))
+
+    def delay(self, name, seconds):
+        self.latency[name.lower().rstrip('.') + '.'] = seconds
+
+    def blackhole(self, name):
+        self.drop.add(name.lower().rstrip('.') + '.')
+
+    def servfail(self, name):
+        # As a resolver answers for a zone whose servers are lame or broken
+        self.failing.add(name.lower().rstrip('.') + '.')
+
+    def _match(self, table, name):
+        # Exact or parent-domain match, so one entry covers a whole subtree
+        return next((table[n] if isinstance(table, dict) else True
+                     for n in table if name == n or name.endswith('.' + n)), None)
+
+    def _rrset(self, name, rdtype):
+        # Parse each RRset once; building them from text per query would make
+        # the stub, not the code under test, the bottleneck
+        key = (name, rdtype)
+        if key not in self._parsed:
+            entry = self.records.get(key)
+            if key == (self.origin, 'SOA'):
+                entry = (300, [SOA_TEXT])
+            self._parsed[key] = entry and dns.rrset.from_text_list(name, entry[0], 'IN', rdtype, entry[1])
+        return self._parsed[key]
+
+    def answer(self, query):
+        question = query.question[0]
+        name = question.name.to_text().lower()
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        response = dns.message.make_response(query)
+
+        rrset = self._rrset(name, rdtype)
+        if self._match(self.failing, name):
+            response.set_rcode(dns.rcode.SERVFAIL)
+        elif rrset:
+            response.answer.append(rrset)
+        else:
+            if name not in self.names:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(self._rrset(self.origin, 'SOA'))
+
+        return response, self._match(self.latency, name) or 0, bool(self._match(self.drop, name))
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = self.server.handle(data, tcp=False)
+        if reply:
+            asyncio.ensure_future(self._send(reply, addr))
+
+    async def _send(self, reply, addr):
+        self.transport.sendto(await reply, addr)
+
+
+class _Background:
+    """An event loop running in a daemon thread"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        # Connections still open would otherwise be torn down after the loop closes
+        self.run(self._cancel_tasks())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    @staticmethod
+    async def _cancel_tasks():
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class StubDNSServer:
+    """Authoritative DNS stub on UDP and TCP that counts every query it answers.
+
+    It runs in a child process, as a real upstream would, so the resolver
+    under test does not share the interpreter (and its GIL) with the server.
+    """
+
+    def __init__(self, zone, host="127.0.0.1", port=0):
+        self.zone = zone
+        self.host = host
+        self.port = port
+        self._queries = Counter()
+        self._tcp_connections = 0
+        self._process = None
+        self._conn = None
+
+    def _stats(self):
+        self._conn.send("stats")
+        return self._conn.recv()
+
+    @property
+    def queries(self):
+        return Counter(self._stats()[0])
+
+    @property
+    def tcp_connections(self):
+        return self._stats()[1]
+
+    @property
+    def total_queries(self):
+        return sum(self.queries.values())
+
+    def reset_counters(self):
+        self._conn.send("reset")
+        self._conn.recv()
+
+    def handle(self, data, tcp):
+        try:
+            query = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return None
+        self._queries[dns.rdatatype.to_text(query.question[0].rdtype)] += 1
+        response, delay, drop = self.zone.answer(query)
+        if drop:
+            return None
+
+        # Truncate UDP answers above the client's advertised EDNS payload size
+        limit = max(query.payload, 512) if query.edns >= 0 else 512
+
+        async def reply():
+            if delay:
+                await asyncio.sleep(delay)
+            wire = response.to_wire(max_size=65535)
+            if not tcp and len(wire) > limit:
+                response.flags |= dns.flags.TC
+                response.answer.clear()
+                wire = response.to_wire()
+            return wire
+        return reply()
+
+    async def _handle_tcp(self, reader, writer):
+        self._tcp_connections += 1
+
+        # Pipelined queries are answered as they become ready, not in order
+        async def respond(reply):
+            wire = await reply
+            writer.write(len(wire).to_bytes(2, 'big') + wire)
+
+        replies = set()
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                reply = self.handle(await reader.readexactly(length), tcp=True)
+                if reply:
+                    task = asyncio.ensure_future(respond(reply))
+                    replies.add(task)
+                    task.add_done_callback(replies.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in replies:
+                task.cancel()
+            writer.close()
+
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UDPProtocol(self), local_addr=(self.host, self.port))
+        self.port = transport.get_extra_info('sockname')[1]
+        # Size the receive buffer like a real server's, so bursts are queued, not dropped
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self._tcp = await asyncio.start_server(self._handle_tcp, self.host, self.port)
+
+    def _serve(self, conn):
+        background = _Background()
+        background.run(self._start())
+        conn.send(self.port)
+        while True:
+            command = conn.recv()
+            if command == "stats":
+                conn.send((dict(self._queries), self._tcp_connections))
+            elif command == "reset":
+                self._queries.clear()
+                self._tcp_connections = 0
+                conn.send(None)
+            else:
+                break
+        background.stop()
+
+    def start(self):
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.get_context("fork").Process(target=self._serve, args=(child,), daemon=True)
+        self._process.start()
+        self.port = self._conn.recv()
+        return self
+
+    def stop(self):
+        self._conn.send("stop")
+        self._process.join()
+
+
+class StubSMTPServer:
+    """Minimal ESMTP server that greets, answers EHLO/HELO and QUIT"""
+
+    EHLO_LINES = ["stub.bench", "SIZE 35882577", "8BITMIME", "STARTTLS",
+                  "AUTH LOGIN PLAIN", "PIPELINING"]
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.sessions = 0
+        self._background = None
+
+    async def _handle(self, reader, writer):
+        self.sessions += 1
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            writer.write(b"220 stub.bench ESMTP ready\r\n")
+            while True:
+                line = (await reader.readline()).upper()
+                if not line or line.startswith(b"QUIT"):
+                    writer.write(b"221 Bye\r\n")
+                    break
+                if line.startswith(b"EHLO"):
+                    lines = self.EHLO_LINES
+                    writer.write("".join(
+                        f"250{'-' if i < len(lines) - 1 else ' '}{text}\r\n"
+                        for i, text in enumerate(lines)).encode())
+                elif line.startswith(b"HELO"):
+                    writer.write(b"250 stub.bench\r\n")
+                else:
+                    writer.write(b"502 Command not implemented\r\n")
+                await writer.drain()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _start(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+
+    def start(self):
+        self._background = _Background()
+        self._background.run(self._start())
+        return self
+
+    def stop(self):
+        self._background.stop()
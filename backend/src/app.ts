@@ -4,6 +4,7 @@ import morgan from "morgan";
 import authRouter from "./modules/v1/auth/auth.route";
 import checkRouter from "./modules/v1/check/check.route";
 import { setupSwagger } from "./lib/swagger";
+import { collectPythonMetrics } from "./lib/python-runner";
 
 const app = express();
 
@@ -27,6 +28,19 @@ app.get("/health", (_req, res) => {
   res.status(200).json({ status: "OK", timestamp: new Date().toISOString() });
 });
 
+// Not proxied by nginx; scraped from inside the deployment network
+app.get("/metrics", async (_req, res) => {
+  try {
+    const body = await collectPythonMetrics();
+    res
+      .status(200)
+      .type("application/openmetrics-text; version=1.0.0; charset=utf-8")
+      .send(body);
+  } catch (error) {
+    res.status(500).json({ status: "ERROR", error });
+  }
+});
+
 app.use("/api/v1/auth", authRouter);
 app.use("/api/v1/check", checkRouter);
 
@@ -1,75 +1,203 @@
-import { spawn } from "child_process";
+import { spawn, ChildProcessWithoutNullStreams } from "child_process";
+import { createInterface } from "readline";
 
-export function runPythonCheck(domain: string): Promise<any> {
-  return new Promise((resolve, reject) => {
-    const process = spawn("python", ["./src/scripts/main.py", domain]);
+const WORKER_SCRIPT = "./src/scripts/main.py";
+const POOL_SIZE = Number(process.env.PYTHON_WORKERS) || 2;
+const CHECK_DEADLINE_SECONDS = Number(process.env.CHECK_DEADLINE_SECONDS) || 10;
+// Backstop for a worker that stops answering; checks return partial results
+// on their own once CHECK_DEADLINE_SECONDS is spent
+const REQUEST_TIMEOUT_MS =
+  Number(process.env.PYTHON_REQUEST_TIMEOUT_MS) || (CHECK_DEADLINE_SECONDS + 5) * 1000;
+const RESTART_DELAY_MS = 500;
 
-    let result = "";
-    let error = "";
+type PendingRequest = {
+  resolve: (value: any) => void;
+  reject: (reason: any) => void;
+  timer: NodeJS.Timeout;
+};
 
-    process.stdout.on("data", (data) => {
-      result += data.toString();
-    });
+class PythonWorker {
+  readonly child: ChildProcessWithoutNullStreams;
+  private pending = new Map<number, PendingRequest>();
+  private stderr = "";
+  alive = true;
+
+  constructor(private onExit: (worker: PythonWorker) => void) {
+    this.child = spawn("python", [WORKER_SCRIPT, "--worker"]);
+
+    createInterface({ input: this.child.stdout }).on("line", (line) =>
+      this.handleLine(line)
+    );
 
-    process.stderr.on("data", (data) => {
-      error += data.toString();
+    this.child.stderr.on("data", (data) => {
+      // Keep only the tail so a noisy worker cannot grow memory unbounded
+      this.stderr = (this.stderr + data.toString()).slice(-4096);
     });
 
-    process.on("close", (code) => {
-      if (code === 0) {
-        try {
-          const json = JSON.parse(result);
-          resolve(json);
-        } catch (err) {
-          reject("Failed to parse JSON from Python");
-        }
-      } else {
-        reject(error || `Python script exited with code ${code}`);
-      }
+    this.child.stdin.on("error", (err) => this.handleExit(err.message));
+    this.child.on("error", (err) => this.handleExit(err.message));
+    this.child.on("close", (code) =>
+      this.handleExit(this.stderr || `Python worker exited with code ${code}`)
+    );
+  }
+
+  get load(): number {
+    return this.pending.size;
+  }
+
+  send(id: number, payload: object): Promise<any> {
+    return new Promise((resolve, reject) => {
+      const timer = setTimeout(() => {
+        this.pending.delete(id);
+        reject("Python check timed out");
+      }, REQUEST_TIMEOUT_MS);
+
+      this.pending.set(id, { resolve, reject, timer });
+      this.child.stdin.write(JSON.stringify({ id, ...payload }) + "\n");
     });
-  });
+  }
+
+  private handleLine(line: string) {
+    let message: any;
+    try {
+      message = JSON.parse(line);
+    } catch (err) {
+      return;
+    }
+
+    const request = this.pending.get(message.id);
+    if (!request) return;
+
+    this.pending.delete(message.id);
+    clearTimeout(request.timer);
+    if (message.error) {
+      request.reject(message.error);
+    } else {
+      request.resolve(message.result);
+    }
+  }
+
+  private handleExit(reason: string) {
+    if (!this.alive) return;
+    this.alive = false;
+
+    for (const request of this.pending.values()) {
+      clearTimeout(request.timer);
+      request.reject(reason);
+    }
+    this.pending.clear();
+    this.onExit(this);
+  }
 }
 
-export function runMailEchoCheck(domain: string): Promise<any> {
-  return new Promise((resolve, reject) => {
-    const process = spawn("python", [
-      "-c",
-      `
-import sys
-sys.path.append('./src/scripts')
-from mail_echo_check import check_mail_echo_with_smtp
-from utils import parse_domain
-import json
-
-domain = "${domain}"
-clean_domain = parse_domain(domain)
-result = check_mail_echo_with_smtp(clean_domain)
-print(json.dumps(result))
-    `,
-    ]);
-
-    let result = "";
-    let error = "";
-
-    process.stdout.on("data", (data) => {
-      result += data.toString();
-    });
+class PythonWorkerPool {
+  private workers: PythonWorker[] = [];
+  private nextId = 1;
 
-    process.stderr.on("data", (data) => {
-      error += data.toString();
+  private spawnWorker(): PythonWorker {
+    const worker = new PythonWorker((dead) => {
+      this.workers = this.workers.filter((w) => w !== dead);
+      setTimeout(() => this.ensureWorkers(), RESTART_DELAY_MS);
     });
+    this.workers.push(worker);
+    return worker;
+  }
+
+  private ensureWorkers() {
+    while (this.workers.length < POOL_SIZE) {
+      this.spawnWorker();
+    }
+  }
 
-    process.on("close", (code) => {
-      if (code === 0) {
-        try {
-          const json = JSON.parse(result);
-          resolve(json);
-        } catch (err) {
-          reject("Failed to parse JSON from Python mail echo check");
+  request(payload: object): Promise<any> {
+    this.ensureWorkers();
+    const worker = this.workers.reduce((least, w) =>
+      w.load < least.load ? w : least
+    );
+    return worker.send(this.nextId++, payload);
+  }
+
+  broadcast(payload: (worker: PythonWorker) => object): Promise<any[]> {
+    this.ensureWorkers();
+    return Promise.all(
+      this.workers.map((w) => w.send(this.nextId++, payload(w)))
+    );
+  }
+}
+
+// Each worker renders its own OpenMetrics exposition; merge them so every
+// metric family appears once with the samples of all workers
+function mergeOpenMetrics(bodies: string[]): string {
+  const families = new Map<string, { meta: string[]; samples: string[] }>();
+
+  for (const body of bodies) {
+    let current: { meta: string[]; samples: string[] } | undefined;
+    for (const line of body.split("\n")) {
+      if (!line || line === "# EOF") continue;
+
+      const header = line.match(/^# (TYPE|HELP) (\S+)/);
+      if (header) {
+        current = families.get(header[2]);
+        if (!current) {
+          current = { meta: [], samples: [] };
+          families.set(header[2], current);
         }
-      } else {
-        reject(error || `Mail echo check exited with code ${code}`);
+        if (!current.meta.some((m) => m.startsWith(`# ${header[1]} `))) {
+          current.meta.push(line);
+        }
+        continue;
       }
-    });
-  });
+      current?.samples.push(line);
+    }
+  }
+
+  const lines = [...families.values()].flatMap((f) => [...f.meta, ...f.samples]);
+  return [...lines, "# EOF"].join("\n") + "\n";
+}
+
+const pool = new PythonWorkerPool();
+const inFlight = new Map<string, Promise<any>>();
+
+// Requests for a check that is already running wait on it instead of
+// sending the same DNS and SMTP work to another worker
+function coalesce(key: string, run: () => Promise<any>): Promise<any> {
+  const existing = inFlight.get(key);
+  if (existing) return existing;
+
+  const promise = run().finally(() => inFlight.delete(key));
+  inFlight.set(key, promise);
+  return promise;
+}
+
+// force re-runs every component instead of reusing unexpired stored results;
+// components limits the check to a subset (spf, dkim, dmarc, mail_echo, smtp)
+export function runPythonCheck(domain: string, force = false, components?: string[]): Promise<any> {
+  const selected = components ? [...new Set(components)].sort().join(",") : "default";
+  return coalesce(`check:${domain.toLowerCase()}:${force}:${selected}`, () =>
+    pool.request({
+      type: "check",
+      domain,
+      force,
+      components,
+      deadline: CHECK_DEADLINE_SECONDS,
+    })
+  );
+}
+
+export function runMailEchoCheck(domain: string): Promise<any> {
+  return coalesce(`mail_echo:${domain.toLowerCase()}`, () =>
+    pool.request({
+      type: "mail_echo",
+      domain,
+      deadline: CHECK_DEADLINE_SECONDS,
+    })
+  );
+}
+
+export async function collectPythonMetrics(): Promise<string> {
+  const results = await pool.broadcast((worker) => ({
+    type: "metrics",
+    labels: { worker: String(worker.child.pid) },
+  }));
+  return mergeOpenMetrics(results.map((r) => r.openmetrics));
 }
@@ -90,7 +90,13 @@ const options = {
                   type: 'object',
                   required: ['domain'],
                   properties: {
-                    domain: { type: 'string', format: 'uri' }
+                    domain: { type: 'string', format: 'uri' },
+                    force: { type: 'boolean', description: 'Re-run every check instead of reusing results whose DNS records have not expired' },
+                    components: {
+                      type: 'array',
+                      items: { type: 'string', enum: ['spf', 'dkim', 'dmarc', 'mail_echo', 'smtp'] },
+                      description: 'Checks to run; defaults to spf, dkim, dmarc and mail_echo'
+                    }
                   }
                 }
               }
@@ -21,26 +21,26 @@ export const checkDomainHandler = async (
     return;
   }
 
-  const { domain } = result.data;
+  const { domain, force, components } = result.data;
   const userId = req.user!.id;
 
   try {
-    const pythonResult = await runPythonCheck(domain);
+    const pythonResult = await runPythonCheck(domain, force, components);
+
+    // A check of some components refreshes only those; keep the others saved before
+    const where = { unique_domain_per_user: { domain, userId } };
+    const saved = components ? await prisma.check.findUnique({ where }) : null;
+    const merged = { ...((saved?.result as Record<string, unknown> | null) ?? {}), ...pythonResult };
 
     const checkResult = await prisma.check.upsert({
-      where: {
-        unique_domain_per_user: {
-          domain,
-          userId,
-        },
-      },
+      where,
       update: {
-        result: pythonResult,
+        result: merged,
         updatedAt: new Date(),
       },
       create: {
         domain,
-        result: pythonResult,
+        result: merged,
         userId,
       },
     });
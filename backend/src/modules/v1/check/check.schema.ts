@@ -7,8 +7,12 @@ const extractDomain = (input: string): string => {
   return input.replace(/^https?:\/\//, "");
 };
 
+export const CHECK_COMPONENTS = ["spf", "dkim", "dmarc", "mail_echo", "smtp"] as const;
+
 export const createCheckSchema = z.object({
   domain: z.string().min(1).transform(extractDomain),
+  force: z.boolean().optional(),
+  components: z.array(z.enum(CHECK_COMPONENTS)).min(1).optional(),
 });
 
 export type CreateCheckInput = z.infer<typeof createCheckSchema>;
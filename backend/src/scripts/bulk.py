@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import asyncio
+import metrics
+
+# Default bound on domains being checked at the same time
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", "50"))
+# Seconds between rewrites of the metrics file during a run
+METRICS_INTERVAL = 15
+
+
+async def _read_domains(stream):
+    loop = asyncio.get_running_loop()
+    while True:
+        # Read off the event loop so a slow producer never stalls running checks
+        line = await loop.run_in_executor(None, stream.readline)
+        if not line:
+            return
+        domain = line.strip()
+        if domain and not domain.startswith('#'):
+            yield domain
+
+
+async def _check_one(domain, check_domain, write):
+    try:
+        write({"domain": domain, "result": await check_domain(domain)})
+    except Exception as e:
+        write({"domain": domain, "error": str(e) or type(e).__name__})
+
+
+def _write_line(out, record):
+    out.write(json.dumps(record) + "\n")
+    out.flush()
+
+
+def write_metrics(path):
+    # Write then rename so a scraper never reads a half-written file
+    with open(f"{path}.tmp", "w") as f:
+        f.write(metrics.render())
+    os.replace(f"{path}.tmp", path)
+
+
+async def _export_metrics(path):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        write_metrics(path)
+
+
+async def run_bulk(stream, check_domain, concurrency=None, out=None, metrics_path=None, journal=None):
+    """Check every domain read from stream, writing one NDJSON line per result.
+
+    journal, if given, gets each domain appended once its result is written.
+    """
+    concurrency = concurrency or BULK_CONCURRENCY
+    out = out or sys.stdout
+
+    def write(record):
+        _write_line(out, record)
+        if journal is not None:
+            journal.write(record["domain"] + "\n")
+            journal.flush()
+
+    exporter = asyncio.create_task(_export_metrics(metrics_path)) if metrics_path else None
+    in_flight = set()
+    try:
+        async for domain in _read_domains(stream):
+            if len(in_flight) >= concurrency:
+                _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.add(asyncio.create_task(_check_one(domain, check_domain, write)))
+
+        if in_flight:
+            await asyncio.wait(in_flight)
+    finally:
+        if exporter:
+            exporter.cancel()
+            write_metrics(metrics_path)
@@ -1,25 +1,105 @@
+import os
+import asyncio
 import dns.resolver
 import dns.exception
+import resolver
+import selector_index
+from utils import Deadline, timeout_result
 from feedback import get_dkim_feedback
 
+DEFAULT_SELECTORS = ['default', 'google', 'k1', 'k2', 's1', 's2', 'dkim', 'mail',
+                     'smtp', 'email', 'selector1', 'selector2', 'mxvault']
 
-def check_dkim(domain):
-    selectors = ['default', 'google', 'k1', 'k2', 's1', 's2', 'dkim', 'mail',
-                 'smtp', 'email', 'selector1', 'selector2', 'mxvault']
-    found_records = []
-
-    for selector in selectors:
-        try:
-            answers = dns.resolver.resolve(
-                f"{selector}._domainkey.{domain}", 'TXT')
-            for rdata in answers:
-                record = str(rdata).strip('"')
-                if record.startswith('v=DKIM1') or ('k=' in record and 'p=' in record):
-                    found_records.append(
-                        {"selector": selector, "record": record})
+# Selectors seen in the wild beyond the defaults; the selector index decides which are probed
+SELECTOR_CATALOG = DEFAULT_SELECTORS + [
+    'selector3', 'k3', 'dkim1', 'dkim2', 'key1', 'key2', 'mail2', 'dk', 'x', 'a1', 'sm', 'mx',
+    'pic', 'krs', 'mandrill', 'mailjet', 'smtpapi', 'sendgrid', 'amazonses', 'hs1', 'hs2', 'cm',
+    'mte1', 'ctct1', 'ctct2', 'spop1024', 's1024', 's2048', 'sig1', 'fm1', 'fm2', 'fm3', 'zoho',
+    'zmail', 'protonmail', 'protonmail2', 'protonmail3', 'mimecast20190104', 'mimecast20230622',
+    'proofpoint', 'everlytickey1', 'everlytickey2', 'mesmtp', 'ovhmo', 'titan1', 'turbo-smtp']
+
+# Shared deadline (seconds) for the whole batch of selector queries
+DKIM_TIMEOUT = float(os.environ.get("DKIM_TIMEOUT", "5"))
+# Upper bound on catalog selectors probed on top of the configured ones
+DKIM_MAX_PROBES = int(os.environ.get("DKIM_MAX_PROBES", "16"))
+# Of those, selectors never found yet tried per check (the same ones for a domain),
+# so that the index can learn them
+DKIM_EXPLORE = int(os.environ.get("DKIM_EXPLORE", "2"))
+
+
+def _configured_selectors():
+    env_selectors = os.environ.get("DKIM_SELECTORS")
+    if env_selectors:
+        return [s.strip() for s in env_selectors.split(',') if s.strip()]
+    return DEFAULT_SELECTORS
+
+
+async def _mx_hosts(domain, deadline):
+    try:
+        answers = await resolver.resolve(domain, 'MX', deadline=deadline)
+    except dns.exception.DNSException:
+        return []
+    return [str(r.exchange).rstrip('.') for r in sorted(answers, key=lambda r: r.preference)]
+
+
+async def _probe_selector(domain, selector, timeout):
+    try:
+        answers = await resolver.resolve(
+            f"{selector}._domainkey.{domain}", 'TXT', lifetime=timeout)
+        for rdata in answers:
+            record = str(rdata).strip('"')
+            if record.startswith('v=DKIM1') or ('k=' in record and 'p=' in record):
+                return {"selector": selector, "record": record}
+    except (dns.resolver.NXDOMAIN, dns.exception.DNSException):
+        pass
+    return None
+
+
+async def _probe_selectors(domain, selectors, first_hit, timeout):
+    """Return (records found, whether the timeout cut probing short)"""
+    tasks = [asyncio.create_task(_probe_selector(domain, selector, timeout))
+             for selector in selectors]
+    found = {}
+    cut_short = False
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=timeout):
+            record = await next_done
+            if record:
+                found[record["selector"]] = record
+                if first_hit:
                     break
-        except (dns.resolver.NXDOMAIN, dns.exception.DNSException):
-            continue
+    except asyncio.TimeoutError:
+        cut_short = True
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Report hits in selector order, not in order of arrival
+    return [found[s] for s in selectors if s in found], cut_short
+
+
+async def check_dkim_async(domain, selectors=None, first_hit=False, timeout=None, deadline=None):
+    """Probe the given selectors, or the configured ones plus catalog selectors the index picks"""
+    deadline = Deadline.of(deadline)
+    if selectors:
+        found_records, cut_short = await _probe_selectors(
+            domain, list(dict.fromkeys(selectors)), first_hit, deadline.remaining(timeout or DKIM_TIMEOUT))
+    else:
+        index = selector_index.get_index()
+        provider, hints = selector_index.infer_provider(await _mx_hosts(domain, deadline))
+        configured = _configured_selectors()
+        extra = index.rank(SELECTOR_CATALOG, provider, hints, limit=DKIM_MAX_PROBES,
+                           explore=DKIM_EXPLORE, exclude=configured, domain=domain)
+        found_records, cut_short = await _probe_selectors(
+            domain, list(dict.fromkeys([*configured, *extra])), first_hit,
+            deadline.remaining(timeout or DKIM_TIMEOUT))
+        if not cut_short and not first_hit:
+            if index.record(provider, [r["selector"] for r in found_records]) >= selector_index.DKIM_INDEX_BATCH:
+                await asyncio.to_thread(index.flush)
+
+    if cut_short and deadline.expired and not found_records:
+        return timeout_result("DKIM")
 
     result = {
         "status": "valid" if found_records else "missing",
@@ -28,8 +108,15 @@ def check_dkim(domain):
         **({"records": found_records} if found_records else {})
     }
 
+    if cut_short and deadline.expired:
+        result["partial"] = True
+
     feedback = get_dkim_feedback(result)
     if feedback:
         result["feedback"] = feedback
 
     return result
+
+
+def check_dkim(domain, selectors=None, first_hit=False, timeout=None, deadline=None):
+    return asyncio.run(check_dkim_async(domain, selectors, first_hit, timeout, deadline))
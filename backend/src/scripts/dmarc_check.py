@@ -1,5 +1,8 @@
+import asyncio
 import dns.resolver
 import dns.exception
+import resolver
+from utils import timeout_result
 from feedback import get_dmarc_feedback
 
 
@@ -11,16 +14,22 @@ def _create_result_with_feedback(status, message):
     return result
 
 
-def check_dmarc(domain):
+async def check_dmarc_async(domain, deadline=None):
     try:
-        answers = dns.resolver.resolve(f"_dmarc.{domain}", 'TXT')
+        answers = await resolver.resolve(f"_dmarc.{domain}", 'TXT', deadline=deadline)
         for rdata in answers:
             record = str(rdata).strip('"')
             if record.startswith('v=DMARC1'):
                 return _create_result_with_feedback("valid", f"DMARC record found: {record}")
         return _create_result_with_feedback("missing", "No DMARC record found")
+    except resolver.DeadlineExceeded:
+        return timeout_result("DMARC")
     except (dns.resolver.NXDOMAIN, dns.exception.DNSException) as e:
         message = "No DMARC record found" if isinstance(
             e, dns.resolver.NXDOMAIN) else f"DNS query failed: {str(e)}"
         status = "missing" if isinstance(e, dns.resolver.NXDOMAIN) else "error"
         return _create_result_with_feedback(status, message)
+
+
+def check_dmarc(domain, deadline=None):
+    return asyncio.run(check_dmarc_async(domain, deadline))
@@ -0,0 +1,131 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+
+# Share of failed calls in a window above which the far end counts as overloaded
+ERROR_THRESHOLD = float(os.environ.get("LIMITER_ERROR_THRESHOLD", "0.2"))
+# A window whose mean latency exceeds the baseline by this factor counts as overloaded
+LATENCY_TOLERANCE = float(os.environ.get("LIMITER_LATENCY_TOLERANCE", "3"))
+# Mean latency (seconds) below which a window never counts as overloaded, so that
+# an upstream answering from its cache does not set an unattainable baseline
+LATENCY_FLOOR = 0.25
+# Fewest completions that make a window, however low the limit
+MIN_WINDOW = 10
+# Factor applied to the limit on overload
+DECREASE_FACTOR = 0.5
+# Seconds after a decrease during which failures are blamed on our own load
+CONGESTION_HOLD = 10.0
+
+
+def backoff(attempt, base=0.1, cap=2.0):
+    """Full-jitter exponential backoff: a random delay up to base * 2**attempt"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AIMDLimiter:
+    """Concurrency limit that adapts to how the far end copes (additive increase,
+    multiplicative decrease).
+
+    Completions are judged in windows of about `limit` calls. A window that saw
+    the limit reached and stayed healthy raises the limit by one (doubles it
+    until the first overload); a window with too many errors, or whose calls
+    took far longer than the best seen, halves it.
+    """
+
+    def __init__(self, name, initial, minimum=1, maximum=1000):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.congested_until = 0.0
+        self.decreases = 0
+        self._baseline = None
+        # Completions still to come of calls started before the last decrease
+        self._stale = 0
+        self._waiters = deque()
+        self._new_window()
+
+    def _new_window(self):
+        self._completions = 0
+        self._errors = 0
+        # Summed over successful calls only: a failure's duration is its timeout
+        self._latency = 0.0
+        self._saturated = False
+
+    @property
+    def congested(self):
+        """Whether the limit came down recently: failures now are likely our own doing"""
+        return time.monotonic() < self.congested_until
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self._take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller gave up
+                self.release()
+            elif future in self._waiters:
+                self._waiters.remove(future)
+            raise
+
+    def _take(self):
+        self.in_flight += 1
+        if self.in_flight >= int(self.limit):
+            self._saturated = True
+
+    def release(self, seconds=None, error=False):
+        """Free a slot; seconds (None when the call was abandoned) and error feed the window"""
+        self.in_flight -= 1
+        if self._stale:
+            # Judge the new limit only on calls it admitted
+            self._stale -= 1
+        elif seconds is not None:
+            self._completions += 1
+            if error:
+                self._errors += 1
+            else:
+                self._latency += seconds
+            if self._completions >= max(int(self.limit), MIN_WINDOW):
+                self._close_window()
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self._take()
+                future.set_result(None)
+
+    def _close_window(self):
+        error_rate = self._errors / self._completions
+        slow = False
+        if self._errors < self._completions:
+            latency = self._latency / (self._completions - self._errors)
+            # The best window latency seen, drifting up slowly so that a far end
+            # that got permanently slower is not held to its old speed forever
+            if self._baseline is None or latency < self._baseline:
+                self._baseline = latency
+            else:
+                self._baseline += (latency - self._baseline) * 0.05
+            slow = latency > max(self._baseline * LATENCY_TOLERANCE, LATENCY_FLOOR)
+
+        if error_rate > ERROR_THRESHOLD or slow:
+            self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+            self.congested_until = time.monotonic() + CONGESTION_HOLD
+            self.decreases += 1
+            self._stale = self.in_flight
+        elif self._saturated:
+            self.limit = min(self.maximum, self.limit * 2 if not self.decreases else self.limit + 1)
+        self._new_window()
+
+    def reset(self):
+        """Forget queued callers and slots in use, keeping the learned limit (e.g. for a new event loop)"""
+        self.in_flight = 0
+        self._stale = 0
+        self._waiters.clear()
+        self._new_window()
@@ -1,20 +1,61 @@
+import os
+import re
+import time
+import asyncio
+from functools import partial
 import dns.resolver
 import dns.exception
 import socket
-import smtplib
+import ipaddress
+import metrics
+import resolver
+from limiter import AIMDLimiter, backoff
+from singleflight import SingleFlight
+from ttl_cache import TTLCache
+from utils import Deadline, timeout_result, inconclusive_result
 from feedback import get_mail_echo_feedback
 
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "25"))
+# One overall deadline (seconds) for probing every MX address of a domain
+SMTP_DEADLINE = float(os.environ.get("SMTP_DEADLINE", "15"))
+# Seconds a server's greeting and capabilities are reused for every domain sharing it
+SMTP_CACHE_TTL = float(os.environ.get("SMTP_CACHE_TTL", "600"))
+# Seconds a failed connection is remembered before the server is tried again
+SMTP_NEGATIVE_TTL = float(os.environ.get("SMTP_NEGATIVE_TTL", "60"))
+# Extra attempts, after a jittered backoff, when a server resets us or answers 4xx
+SMTP_RETRIES = int(os.environ.get("SMTP_RETRIES", "1"))
 
-def check_mail_mx_only(domain):
+_FEATURE_RE = re.compile(r'(?P<feature>[A-Za-z0-9][A-Za-z0-9\-]*) ?(?P<params>.*)')
+_local_hostname = None
+_probes = SingleFlight("smtp")
+# address: smtp_info, or the connection error to raise again
+_capabilities = TTLCache(maxsize=int(os.environ.get("SMTP_CACHE_SIZE", "10000")))
+SMTP_INITIAL_CONCURRENCY = int(os.environ.get("SMTP_INITIAL_CONCURRENCY", "16"))
+SMTP_MAX_CONCURRENCY = int(os.environ.get("SMTP_MAX_CONCURRENCY", "128"))
+# Destination networks whose limiter is remembered; idle ones are dropped beyond this
+SMTP_LIMITERS = 4096
+# destination network: SMTP conversations in flight there, backing off when it
+# starts throttling us, so that one overloaded provider does not hold up the others
+_limiters = {}
+
+
+class TransientReply(ConnectionError):
+    """A 4xx reply: the server is busy or throttling us, not misconfigured"""
+
+
+def _create_result_with_feedback(status, message, domain, **kwargs):
+    result = {"status": status, "message": message, "domain": domain, **kwargs}
+    feedback = get_mail_echo_feedback(result)
+    if feedback:
+        result["feedback"] = feedback
+    return result
+
+
+async def check_mail_mx_only_async(domain, deadline=None):
     try:
-        mx_records = dns.resolver.resolve(domain, 'MX')
+        mx_records = await resolver.resolve(domain, 'MX', deadline=deadline)
         if not mx_records:
-            result = {"status": "error",
-                      "message": "No MX records found", "domain": domain}
-            feedback = get_mail_echo_feedback(result)
-            if feedback:
-                result["feedback"] = feedback
-            return result
+            return _create_result_with_feedback("error", "No MX records found", domain)
 
         mx_servers = [str(record.exchange).rstrip('.')
                       for record in mx_records]
@@ -25,155 +66,349 @@ def check_mail_mx_only(domain):
         }
 
     except dns.resolver.NXDOMAIN:
-        result = {"status": "error",
-                  "message": "Domain not found", "domain": domain}
-        feedback = get_mail_echo_feedback(result)
-        if feedback:
-            result["feedback"] = feedback
-        return result
+        return _create_result_with_feedback("error", "Domain not found", domain)
+
+    except resolver.DeadlineExceeded:
+        return timeout_result("MX", domain=domain)
 
     except dns.exception.DNSException as e:
-        result = {"status": "error",
-                  "message": f"DNS query failed: {str(e)}", "domain": domain}
-        feedback = get_mail_echo_feedback(result)
-        if feedback:
-            result["feedback"] = feedback
-        return result
+        return _create_result_with_feedback("error", f"DNS query failed: {str(e)}", domain)
+
+
+async def _ehlo_hostname():
+    global _local_hostname
+    if _local_hostname is None:
+        _local_hostname = await asyncio.to_thread(socket.getfqdn)
+    return _local_hostname
 
 
-def check_mail_echo_with_smtp(domain):
+async def _read_reply(reader):
+    """Read a (possibly multi-line) SMTP reply, returning (code, lines)"""
+    lines = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Connection unexpectedly closed")
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        lines.append(line[4:].strip())
+        if line[3:4] != '-':
+            return int(line[:3]), lines
+
+
+async def _command(reader, writer, command):
+    writer.write(f"{command}\r\n".encode())
+    await writer.drain()
+    return await _read_reply(reader)
+
+
+def _parse_features(lines):
+    features = {}
+    for line in lines[1:]:
+        match = _FEATURE_RE.match(line)
+        if match:
+            features[match.group("feature").lower()] = match.group("params").strip()
+    return features
+
+
+async def _step(address, step, awaitable):
+    """Await one SMTP step, recording its duration and outcome"""
+    started = time.perf_counter()
+    outcome = "ok"
+    congestion = False
     try:
-        mx_records = dns.resolver.resolve(domain, 'MX')
-        if not mx_records:
-            result = {"status": "error",
-                      "message": "No MX records found", "domain": domain}
-            feedback = get_mail_echo_feedback(result)
-            if feedback:
-                result["feedback"] = feedback
-            return result
+        return await awaitable
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        congestion = _limiter_for(address).congested
+        raise
+    except Exception as e:
+        outcome = "error"
+        congestion = _transient(e) and _limiter_for(address).congested
+        raise
+    finally:
+        metrics.observe_smtp(address, step, time.perf_counter() - started, outcome, congestion)
+
+
+async def _smtp_conversation(address):
+    reader, writer = await _step(address, "connect", asyncio.open_connection(address, SMTP_PORT))
+    try:
+        # Get initial server greeting
+        code, greeting = await _step(address, "banner", _read_reply(reader))
+        if code != 220:
+            error = TransientReply if 400 <= code < 500 else ConnectionError
+            raise error(f"Unexpected greeting: {code} {' '.join(greeting)}")
+
+        # Send EHLO/HELO command
+        hostname = await _ehlo_hostname()
+        code, response = await _step(address, "ehlo", _command(reader, writer, f"EHLO {hostname}"))
+        features = {}
+        if code == 250:
+            features = _parse_features(response)
+        else:
+            code, response = await _step(address, "helo", _command(reader, writer, f"HELO {hostname}"))
 
-        primary_mx = min(mx_records, key=lambda x: x.preference)
-        mx_host = str(primary_mx.exchange).rstrip('.')
+        smtp_info = {
+            "greeting": "\n".join(greeting),
+            "ehlo_response": "\n".join(response),
+            "capabilities": list(features.keys())
+        }
+        if "starttls" in features:
+            smtp_info["starttls_available"] = True
+        if "auth" in features:
+            smtp_info["auth_methods"] = features["auth"].split()
 
+        # Close the connection properly
         try:
-            # Establish connection to SMTP server
-            server = smtplib.SMTP(mx_host, 25, timeout=15)
-
-            # Get initial server greeting
-            greeting = server.getheader() if hasattr(
-                server, 'getheader') else "Connected successfully"
-
-            # Send EHLO/HELO command
-            code, response = server.ehlo()
-            if code != 250:
-                code, response = server.helo()
-
-            server_response = response.decode(
-                'utf-8') if isinstance(response, bytes) else str(response)
-
-            # Test basic SMTP commands
-            smtp_info = {
-                "greeting": greeting,
-                "ehlo_response": server_response,
-                "capabilities": []
-            }
-
-            # Check for common SMTP extensions
-            if hasattr(server, 'esmtp_features'):
-                smtp_info["capabilities"] = list(server.esmtp_features.keys())
-
-            # Test STARTTLS if available
-            if server.has_extn('STARTTLS'):
-                smtp_info["starttls_available"] = True
-
-            # Test authentication methods if available
-            if server.has_extn('AUTH'):
-                auth_methods = server.esmtp_features.get('auth', '').split()
-                smtp_info["auth_methods"] = auth_methods
-
-            # Close the connection properly
-            server.quit()
-
-            # Format the response
-            response_lines = [f"Connected to {mx_host}"]
-            if smtp_info.get("greeting"):
-                response_lines.append(f"Greeting: {smtp_info['greeting']}")
-            response_lines.append(
-                f"EHLO Response: {smtp_info['ehlo_response']}")
-
-            if smtp_info.get("capabilities"):
-                response_lines.append(
-                    f"Capabilities: {', '.join(smtp_info['capabilities'])}")
-            if smtp_info.get("starttls_available"):
-                response_lines.append("STARTTLS: Available")
-            if smtp_info.get("auth_methods"):
-                response_lines.append(
-                    f"Auth Methods: {', '.join(smtp_info['auth_methods'])}")
-
-            return {
-                "status": "ok",
-                "message": f"Mail server responding: {mx_host}",
-                "echo": "\n".join(response_lines),
-                "mx_host": mx_host,
-                "domain": domain,
-                "smtp_info": smtp_info
-            }
-
-        except smtplib.SMTPConnectError as e:
-            mx_servers = [str(record.exchange).rstrip('.')
-                          for record in mx_records]
-            result = {
-                "status": "warning",
-                "message": f"MX records found ({', '.join(mx_servers[:3])}) but SMTP connection failed: {str(e)}",
-                "domain": domain
-            }
-            feedback = get_mail_echo_feedback(result)
-            if feedback:
-                result["feedback"] = feedback
-            return result
-
-        except smtplib.SMTPServerDisconnected as e:
-            mx_servers = [str(record.exchange).rstrip('.')
-                          for record in mx_records]
-            result = {
-                "status": "warning",
-                "message": f"MX records found ({', '.join(mx_servers[:3])}) but server disconnected: {str(e)}",
-                "domain": domain
-            }
-            feedback = get_mail_echo_feedback(result)
-            if feedback:
-                result["feedback"] = feedback
-            return result
-
-        except (socket.timeout, socket.error, smtplib.SMTPException) as smtp_error:
-            mx_servers = [str(record.exchange).rstrip('.')
-                          for record in mx_records]
-            result = {
-                "status": "warning",
-                "message": f"MX records found ({', '.join(mx_servers[:3])}) but mail server not responding: {str(smtp_error)}",
-                "domain": domain
-            }
-            feedback = get_mail_echo_feedback(result)
-            if feedback:
-                result["feedback"] = feedback
-            return result
+            await _step(address, "quit", asyncio.wait_for(_command(reader, writer, "QUIT"), 2))
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        return smtp_info
+    finally:
+        writer.close()
 
-    except dns.resolver.NXDOMAIN:
-        result = {"status": "error",
-                  "message": "Domain not found", "domain": domain}
-        feedback = get_mail_echo_feedback(result)
-        if feedback:
-            result["feedback"] = feedback
-        return result
 
+def _destination(address):
+    # A provider's mail servers usually share a network, and its capacity
+    network = ipaddress.ip_network(f"{address}/{24 if ':' not in address else 48}", strict=False)
+    return str(network)
+
+
+def _limiter_for(address):
+    key = _destination(address)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        if len(_limiters) >= SMTP_LIMITERS:
+            for idle in [k for k, l in _limiters.items() if not l.in_flight and not l.congested]:
+                del _limiters[idle]
+        limiter = _limiters[key] = AIMDLimiter(
+            f"smtp {key}", SMTP_INITIAL_CONCURRENCY, maximum=SMTP_MAX_CONCURRENCY)
+    return limiter
+
+
+def _transient(error):
+    """Whether error is the server throttling or dropping us: a sign of load, worth a retry.
+
+    5xx replies, early closes, refusals and unreachable networks are not.
+    """
+    return isinstance(error, (TransientReply, ConnectionResetError, TimeoutError))
+
+
+async def _limited_conversation(address):
+    limiter = _limiter_for(address)
+    await limiter.acquire()
+    started = time.monotonic()
+    error = None
+    abandoned = False
+    try:
+        return await _smtp_conversation(address)
+    except asyncio.CancelledError:
+        abandoned = True
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        # Only load signs feed the limit: a refusal or a 5xx says nothing about
+        # how busy the server is, and its quick answer nothing about its speed
+        limiter.release(None if abandoned or (error is not None and not _transient(error))
+                        else time.monotonic() - started, error is not None)
+
+
+async def _attempts(address):
+    for attempt in range(SMTP_RETRIES + 1):
+        try:
+            return await _limited_conversation(address)
+        except (OSError, ConnectionError, ValueError) as e:
+            if _transient(e) and attempt < SMTP_RETRIES:
+                metrics.observe_retry("smtp", type(e).__name__)
+                await asyncio.sleep(backoff(attempt, base=0.5))
+                continue
+            raise
+
+
+async def _converse(address):
+    try:
+        # Bounded on its own: the conversation is shared, so it has to end,
+        # free its slot and be cached even once every caller has given up
+        smtp_info = await asyncio.wait_for(_attempts(address), SMTP_DEADLINE)
+    except asyncio.TimeoutError:
+        e = TimeoutError(f"No SMTP response within {SMTP_DEADLINE:g}s")
+        congested = _limiter_for(address).congested
+        # A server silent that long is as good as down, unless its network is backing off
+        if not congested:
+            _capabilities.set(address, e, SMTP_NEGATIVE_TTL)
+        e.congestion = congested
+        raise e from None
+    except (OSError, ConnectionError, ValueError) as e:
+        # Throttling says nothing lasting about the server, and while its
+        # network backs off may well be our own doing
+        if not _transient(e):
+            _capabilities.set(address, e, SMTP_NEGATIVE_TTL)
+        e.congestion = _transient(e) and _limiter_for(address).congested
+        raise
+    _capabilities.set(address, smtp_info, SMTP_CACHE_TTL)
+    return smtp_info
+
+
+async def _probe_address(probe):
+    started = time.monotonic()
+    address = probe["address"]
+    try:
+        # Domains sharing a mail server reuse its last conversation, and
+        # concurrent probes of the same server share one connection
+        smtp_info = _capabilities.get(address)
+        if smtp_info is not None:
+            probe["cached"] = True
+            if isinstance(smtp_info, Exception):
+                raise smtp_info.with_traceback(None)
+        else:
+            smtp_info = await _probes.do(address, partial(_converse, address))
+        probe.update(reachable=True, smtp_info=smtp_info)
+    except (OSError, ConnectionError, ValueError) as e:
+        probe.update(reachable=False, error=str(e) or type(e).__name__)
+        if getattr(e, "congestion", False):
+            probe["congestion"] = True
+    probe["latency_ms"] = round((time.monotonic() - started) * 1000, 1)
+
+
+async def _host_addresses(host, deadline):
+    addresses = []
+    for rdtype in ('A', 'AAAA'):
+        try:
+            addresses.extend(str(r) for r in await resolver.resolve(host, rdtype, deadline=deadline))
+        except dns.exception.DNSException:
+            continue
+    return addresses
+
+
+async def _probe_mx_hosts(mx_hosts, deadline):
+    """Probe every address of every MX host at once, stopping at the deadline"""
+    wait = deadline.remaining(SMTP_DEADLINE)
+    started = time.monotonic()
+    probes = []
+
+    async def probe_host(preference, host):
+        addresses = await _host_addresses(host, deadline)
+        if not addresses:
+            probes.append({"host": host, "preference": preference, "reachable": False,
+                           "error": "No A/AAAA records for MX host"})
+        host_probes = [{"host": host, "preference": preference, "address": address}
+                       for address in addresses]
+        probes.extend(host_probes)
+        await asyncio.gather(*(_probe_address(p) for p in host_probes))
+
+    task = asyncio.ensure_future(asyncio.gather(
+        *(probe_host(preference, host) for preference, host in mx_hosts)))
+    _, pending = await asyncio.wait({task}, timeout=wait)
+    if pending:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    elapsed = round((time.monotonic() - started) * 1000, 1)
+    for probe in probes:
+        if "reachable" not in probe:
+            probe.update(reachable=False, error="No response before deadline", latency_ms=elapsed)
+    return sorted(probes, key=lambda p: (p["preference"], p["host"]))
+
+
+def _format_echo(mx_host, smtp_info):
+    response_lines = [f"Connected to {mx_host}"]
+    if smtp_info.get("greeting"):
+        response_lines.append(f"Greeting: {smtp_info['greeting']}")
+    response_lines.append(
+        f"EHLO Response: {smtp_info['ehlo_response']}")
+
+    if smtp_info.get("capabilities"):
+        response_lines.append(
+            f"Capabilities: {', '.join(smtp_info['capabilities'])}")
+    if smtp_info.get("starttls_available"):
+        response_lines.append("STARTTLS: Available")
+    if smtp_info.get("auth_methods"):
+        response_lines.append(
+            f"Auth Methods: {', '.join(smtp_info['auth_methods'])}")
+    return "\n".join(response_lines)
+
+
+async def check_mail_echo_with_smtp_async(domain, deadline=None):
+    deadline = Deadline.of(deadline)
+    try:
+        mx_records = await resolver.resolve(domain, 'MX', deadline=deadline)
+        if not mx_records:
+            return _create_result_with_feedback("error", "No MX records found", domain)
+    except dns.resolver.NXDOMAIN:
+        return _create_result_with_feedback("error", "Domain not found", domain)
+    except resolver.DeadlineExceeded:
+        return timeout_result("mail echo", domain=domain)
     except dns.exception.DNSException as e:
-        result = {"status": "error",
-                  "message": f"DNS query failed: {str(e)}", "domain": domain}
-        feedback = get_mail_echo_feedback(result)
-        if feedback:
-            result["feedback"] = feedback
-        return result
+        return _create_result_with_feedback("error", f"DNS query failed: {str(e)}", domain)
+
+    mx_hosts = sorted({(r.preference, str(r.exchange).rstrip('.')) for r in mx_records})
+    probes = await _probe_mx_hosts(mx_hosts, deadline)
+    hosts = [{k: v for k, v in p.items() if k != "smtp_info"} for p in probes]
+
+    reachable = [p for p in probes if p["reachable"]]
+    if not reachable and deadline.expired:
+        return timeout_result("mail echo", domain=domain, hosts=hosts)
+    if not reachable and any(p.get("congestion") for p in probes):
+        # Busy or throttling servers, or our own overload: no verdict on the domain
+        return inconclusive_result("mail echo", domain=domain, hosts=hosts)
+    if not reachable:
+        mx_servers = [host for _, host in mx_hosts]
+        error = probes[0]["error"] if probes else "No response before deadline"
+        return _create_result_with_feedback(
+            "warning",
+            f"MX records found ({', '.join(mx_servers[:3])}) but mail server not responding: {error}",
+            domain,
+            hosts=hosts
+        )
+
+    preferred = min(reachable, key=lambda p: (p["preference"], p["latency_ms"]))
+    mx_host = preferred["host"]
+    return {
+        "status": "ok",
+        "message": f"Mail server responding: {mx_host}",
+        "echo": _format_echo(mx_host, preferred["smtp_info"]),
+        "mx_host": mx_host,
+        "domain": domain,
+        "smtp_info": preferred["smtp_info"],
+        "hosts": hosts
+    }
+
+
+def check_mail_mx_only(domain, deadline=None):
+    return asyncio.run(check_mail_mx_only_async(domain, deadline))
+
+
+def check_mail_echo_with_smtp(domain, deadline=None):
+    return asyncio.run(check_mail_echo_with_smtp_async(domain, deadline))
+
+
+async def check_mail_echo_async(domain, deadline=None):
+    return await check_mail_mx_only_async(domain, deadline)
+
+
+def check_mail_echo(domain, deadline=None):
+    return asyncio.run(check_mail_echo_async(domain, deadline))
+
+
+def smtp_cache_stats():
+    return _capabilities.stats()
+
+
+def clear_smtp_cache():
+    _capabilities.clear()
+
+
+def _collect_smtp_cache_metrics():
+    stats = _capabilities.stats()
+    return [
+        ("smtp_cache_hits", "counter", "SMTP probes answered from the capability cache", stats["hits"]),
+        ("smtp_cache_misses", "counter", "SMTP probes that needed a conversation", stats["misses"]),
+        ("smtp_cache_entries", "gauge", "Mail servers held in the capability cache", stats["size"]),
+    ]
 
 
-def check_mail_echo(domain):
-    return check_mail_mx_only(domain)
+metrics.register_collector(_collect_smtp_cache_metrics)
@@ -1,25 +1,174 @@
 import sys
 import json
-from spf_check import check_spf
-from dkim_check import check_dkim
-from dmarc_check import check_dmarc
-from mail_echo_check import check_mail_echo
-from utils import parse_domain
+import time
+import asyncio
+import argparse
+from functools import partial
+import metrics
+import planner
+import result_store
+from singleflight import SingleFlight
+from utils import parse_domain, Deadline, timeout_result, inconclusive_result
 
 
-def check_domain(domain):
+# Slack (seconds) given to a check past the budget to return its partial result
+DEADLINE_GRACE = 0.5
+
+_checks = SingleFlight("check")
+
+
+async def _within(component, check, coro, deadline):
+    """Run one check under the budget, returning (result, timing)"""
+    remaining = deadline.remaining()
+    started = time.perf_counter()
+    with metrics.trace() as events:
+        try:
+            result = await asyncio.wait_for(coro, None if remaining is None else remaining + DEADLINE_GRACE)
+        except asyncio.TimeoutError:
+            result = timeout_result(check)
+    # Failures caused by our own overload must not read as faults in the domain
+    if result.get("status") not in ("ok", "valid", "inconclusive") and any(e.get("congestion") for e in events):
+        result = inconclusive_result(check, **({"domain": result["domain"]} if "domain" in result else {}))
+    if result.get("congestion"):
+        metrics.observe_inconclusive(component)
+    duration = time.perf_counter() - started
+    metrics.observe_check(component, duration, result.get("status"))
+    return result, {"duration_ms": round(duration * 1000, 2), "events": events}
+
+
+async def _check_domain(clean_domain, deadline, timings, force, components):
+    deadline = Deadline.of(deadline)
+    started = time.perf_counter()
+
+    # Reuse stored components whose DNS data has not expired; re-run the rest
+    store = result_store.get_store()
+    storable = [c for c in components if c in planner.STORED_COMPONENTS]
+    stored = {} if store is None or force else await asyncio.to_thread(store.load, clean_domain, storable)
+    if store is not None:
+        for component in storable:
+            metrics.observe_result_store(component, component in stored)
+    stale = [component for component in components if component not in stored]
+    checks = planner.run(clean_domain, stale, deadline)
+    outcomes = await asyncio.gather(*(
+        _within(component, planner.COMPONENTS[component][0], checks[component], deadline)
+        for component in stale))
+
+    result = {}
+    timing = {}
+    flush = False
+    for component in components:
+        if component in stored:
+            result[component], checked_at, expires_at = stored[component]
+            timing[component] = {"cached": True, "checked_at": checked_at,
+                                 "expires_in": round(expires_at - time.time(), 1)}
+            continue
+        result[component], timing[component] = outcomes[stale.index(component)]
+        if store is not None and component in storable:
+            flush = store.save(clean_domain, component, result[component],
+                               result_store.result_ttl(result[component], timing[component]["events"]))
+    if flush:
+        await asyncio.to_thread(store.flush)
+
+    if timings:
+        result["timings"] = {"total_ms": round((time.perf_counter() - started) * 1000, 2), **timing}
+    return result
+
+
+async def check_domain_async(domain, deadline=None, timings=False, force=False, components=None):
+    """Check domain for components (see planner.COMPONENTS), all default ones when None"""
     clean_domain = parse_domain(domain)
-    return {
-        "spf": check_spf(clean_domain),
-        "dkim": check_dkim(clean_domain),
-        "dmarc": check_dmarc(clean_domain),
-        "mail_echo": check_mail_echo(clean_domain)
-    }
+    components = planner.parse_components(components)
+    # Concurrent checks of the same domain wait on the one already running
+    return await _checks.do((clean_domain.lower(), timings, force, components),
+                            partial(_check_domain, clean_domain, deadline, timings, force, components))
+
+
+def check_domain(domain, deadline=None, timings=False, force=False, components=None):
+    return asyncio.run(check_domain_async(domain, deadline, timings, force, components))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Email domain checks")
+    parser.add_argument("domain", nargs="?")
+    parser.add_argument("--worker", action="store_true",
+                        help="serve NDJSON requests on stdin/stdout")
+    parser.add_argument("--bulk", metavar="FILE", nargs="?", const="-",
+                        help="check one domain per line from FILE (default: stdin), writing NDJSON")
+    parser.add_argument("--scan", metavar="FILE",
+                        help="check one domain per line from FILE across a process pool, resumably")
+    parser.add_argument("--out", metavar="DIR",
+                        help="directory for the per-shard results and journals of --scan")
+    parser.add_argument("--shards", type=int,
+                        help="shards a new --scan is split into (default: CPU count)")
+    parser.add_argument("--processes", type=int,
+                        help="processes checking shards at once in --scan mode (default: CPU count)")
+    parser.add_argument("--concurrency", type=int,
+                        help="maximum number of domains checked at once in bulk mode (per process for --scan)")
+    parser.add_argument("--check-host", metavar="DOMAIN",
+                        help="evaluate SPF for DOMAIN against IPs read one per line from stdin")
+    parser.add_argument("--deadline", type=float,
+                        help="time budget in seconds for each domain check")
+    parser.add_argument("--timings", action="store_true",
+                        help="include per-query timings in each result")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write aggregate OpenMetrics to FILE in bulk mode")
+    parser.add_argument("--store", metavar="FILE",
+                        help="SQLite result store to reuse unexpired component results from")
+    parser.add_argument("--force", action="store_true",
+                        help="re-run every component even when a stored result is still valid")
+    parser.add_argument("--components", metavar="LIST",
+                        help=f"comma-separated components to check, out of {', '.join(planner.COMPONENTS)} "
+                             f"(default: {','.join(planner.DEFAULT_COMPONENTS)})")
+    args = parser.parse_args()
+    if args.scan and not args.out:
+        parser.error("--scan requires --out")
+    try:
+        args.components = planner.parse_components(args.components)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    args = _parse_args()
+    if args.store:
+        result_store.configure(args.store)
+
+    if args.worker:
+        from worker import serve
+        asyncio.run(serve(check_domain_async))
+        sys.exit(0)
+
+    if args.bulk:
+        from bulk import run_bulk
+        check = partial(check_domain_async, deadline=args.deadline, timings=args.timings,
+                        force=args.force, components=args.components)
+        if args.bulk == "-":
+            asyncio.run(run_bulk(sys.stdin, check, args.concurrency, metrics_path=args.metrics))
+        else:
+            with open(args.bulk) as stream:
+                asyncio.run(run_bulk(stream, check, args.concurrency, metrics_path=args.metrics))
+        sys.exit(0)
+
+    if args.scan:
+        from scan import run_scan
+        try:
+            summary = run_scan(args.scan, args.out, args.shards, args.processes, args.concurrency, args.store,
+                               deadline=args.deadline, timings=args.timings, force=args.force,
+                               components=args.components)
+        except ValueError as e:
+            print(json.dumps({"error": str(e)}))
+            sys.exit(1)
+        print(json.dumps(summary))
+        sys.exit(0)
+
+    if args.check_host:
+        from spf_eval import run_check_host
+        asyncio.run(run_check_host(args.check_host, sys.stdin, sys.stdout))
+        sys.exit(0)
+
+    if not args.domain:
         print(json.dumps({"error": "Domain argument is missing"}))
         sys.exit(1)
 
-    print(json.dumps(check_domain(sys.argv[1])))
+    print(json.dumps(check_domain(args.domain, args.deadline, args.timings, args.force, args.components)))
@@ -0,0 +1,164 @@
+import contextvars
+from contextlib import contextmanager
+
+PREFIX = "mailcheck"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current_trace = contextvars.ContextVar("mailcheck_trace", default=None)
+
+_FAMILIES = {
+    "dns_queries": ("counter", "DNS queries by record type, outcome and cache use"),
+    "dns_query_duration_seconds": ("histogram", "DNS query latency including cache hits"),
+    "smtp_steps": ("counter", "SMTP conversation steps by outcome"),
+    "smtp_step_duration_seconds": ("histogram", "SMTP conversation step latency"),
+    "checks": ("counter", "Completed checks by component and status"),
+    "result_store_lookups": ("counter", "Stored component results reused or re-checked"),
+    "singleflight_calls": ("counter", "Coalesced calls by kind, started or joined in flight"),
+    "retries": ("counter", "DNS queries and SMTP probes retried after a transient failure"),
+    "inconclusive_checks": ("counter", "Checks whose failures were put down to our own congestion"),
+    "check_duration_seconds": ("histogram", "Check latency by component"),
+}
+
+_counters = {}
+_histograms = {}
+_collectors = []
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _inc(family, labels, value=1):
+    series = _counters.setdefault(family, {})
+    key = _labels_key(labels)
+    series[key] = series.get(key, 0) + value
+
+
+def _observe(family, labels, seconds):
+    series = _histograms.setdefault(family, {})
+    key = _labels_key(labels)
+    histogram = series.get(key)
+    if histogram is None:
+        histogram = series[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            histogram["buckets"][i] += 1
+    histogram["sum"] += seconds
+    histogram["count"] += 1
+
+
+def _record(event):
+    events = _current_trace.get()
+    if events is not None:
+        events.append(event)
+
+
+@contextmanager
+def trace():
+    """Collect the DNS and SMTP events of the enclosed check (and its tasks)"""
+    events = []
+    token = _current_trace.set(events)
+    try:
+        yield events
+    finally:
+        _current_trace.reset(token)
+
+
+def observe_dns(qname, rdtype, seconds, outcome, cache_hit, ttl=None, congestion=False):
+    cache = "hit" if cache_hit else "miss"
+    _inc("dns_queries", {"rdtype": rdtype, "outcome": outcome, "cache": cache})
+    _observe("dns_query_duration_seconds", {"rdtype": rdtype, "cache": cache}, seconds)
+    event = {"type": "dns", "name": str(qname), "rdtype": rdtype, "outcome": outcome,
+             "cache": cache, "duration_ms": round(seconds * 1000, 2)}
+    if ttl is not None:
+        event["ttl"] = round(ttl, 1)
+    if congestion:
+        event["congestion"] = True
+    _record(event)
+
+
+def observe_memo(kind, name, ttl):
+    """Record a memoized answer (e.g. an SPF subtree) used instead of DNS queries"""
+    _record({"type": "memo", "kind": kind, "name": name, "ttl": round(ttl, 1)})
+
+
+def observe_smtp(address, step, seconds, outcome, congestion=False):
+    _inc("smtp_steps", {"step": step, "outcome": outcome})
+    _observe("smtp_step_duration_seconds", {"step": step}, seconds)
+    event = {"type": "smtp", "address": address, "step": step, "outcome": outcome,
+             "duration_ms": round(seconds * 1000, 2)}
+    if congestion:
+        event["congestion"] = True
+    _record(event)
+
+
+def observe_check(component, seconds, status):
+    _inc("checks", {"component": component, "status": status or "unknown"})
+    _observe("check_duration_seconds", {"component": component}, seconds)
+
+
+def observe_result_store(component, hit):
+    _inc("result_store_lookups", {"component": component, "outcome": "hit" if hit else "miss"})
+
+
+def observe_flight(kind, joined):
+    _inc("singleflight_calls", {"kind": kind, "role": "joined" if joined else "started"})
+
+
+def observe_retry(kind, reason):
+    _inc("retries", {"kind": kind, "reason": reason})
+
+
+def observe_inconclusive(component):
+    _inc("inconclusive_checks", {"component": component})
+
+
+def register_collector(collect):
+    """collect() returns [(name, type, help, value)] gauges/counters read at render time"""
+    _collectors.append(collect)
+
+
+def _format_labels(labels, extra):
+    pairs = list(extra.items()) + list(labels)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render(extra_labels=None):
+    """Render every metric family in the OpenMetrics text format"""
+    extra = dict(extra_labels or {})
+    lines = []
+    for family, (metric_type, help_text) in _FAMILIES.items():
+        name = f"{PREFIX}_{family}"
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"# HELP {name} {help_text}.")
+        if metric_type == "counter":
+            for labels, value in _counters.get(family, {}).items():
+                lines.append(f"{name}_total{_format_labels(labels, extra)} {value}")
+            continue
+        for labels, histogram in _histograms.get(family, {}).items():
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                bucket_labels = labels + (("le", str(bound)),)
+                lines.append(f"{name}_bucket{_format_labels(bucket_labels, extra)} {count}")
+            inf_labels = labels + (("le", "+Inf"),)
+            lines.append(f"{name}_bucket{_format_labels(inf_labels, extra)} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels, extra)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels, extra)} {histogram['count']}")
+
+    for collect in _collectors:
+        for family, metric_type, help_text, value in collect():
+            name = f"{PREFIX}_{family}"
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"# HELP {name} {help_text}.")
+            suffix = "_total" if metric_type == "counter" else ""
+            lines.append(f"{name}{suffix}{_format_labels((), extra)} {value}")
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    _counters.clear()
+    _histograms.clear()
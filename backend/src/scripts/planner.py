@@ -0,0 +1,73 @@
+import asyncio
+import dns.exception
+import resolver
+from spf_check import check_spf_async
+from dkim_check import check_dkim_async
+from dmarc_check import check_dmarc_async
+from mail_echo_check import check_mail_echo_async, check_mail_echo_with_smtp_async
+
+# component: (name used in timeout results, apex record types it reads, check)
+COMPONENTS = {
+    "spf": ("SPF", ("TXT",), check_spf_async),
+    "dkim": ("DKIM", ("MX",), lambda domain, deadline: check_dkim_async(domain, deadline=deadline)),
+    "dmarc": ("DMARC", (), check_dmarc_async),
+    "mail_echo": ("MX", ("MX",), check_mail_echo_async),
+    "smtp": ("mail echo", ("MX",), check_mail_echo_with_smtp_async),
+}
+DEFAULT_COMPONENTS = ("spf", "dkim", "dmarc", "mail_echo")
+# Results bounded by DNS TTLs alone; a mail server's reachability is not
+STORED_COMPONENTS = ("spf", "dkim", "dmarc", "mail_echo")
+# Components querying many names below the apex wait for the apex answers, so
+# that a missing domain settles all of those names from the NXDOMAIN cut.
+# Single-query components start at once rather than pay the extra round trip.
+FAN_OUT_COMPONENTS = ("dkim",)
+
+
+def parse_components(value):
+    """Components from "spf,dmarc" or a list, in canonical order; None means the defaults"""
+    if value is None:
+        return DEFAULT_COMPONENTS
+    if isinstance(value, str):
+        value = value.split(',')
+    requested = {c.strip().lower() for c in value if c.strip()}
+    unknown = requested - COMPONENTS.keys()
+    if unknown:
+        raise ValueError(f"Unknown components: {', '.join(sorted(unknown))}")
+    if not requested:
+        raise ValueError("No components requested")
+    return tuple(c for c in COMPONENTS if c in requested)
+
+
+def apex_type(components):
+    """Apex record type the fan-out components wait for, if any: one answer
+    tells whether the domain exists, and another component reads it anyway"""
+    if not any(c in FAN_OUT_COMPONENTS for c in components):
+        return None
+    return next((t for c in components for t in COMPONENTS[c][1]), "TXT")
+
+
+async def _resolve_apex(domain, rdtype, deadline):
+    # The answer or error lands in the shared cache; an NXDOMAIN also cuts
+    # off every name below the apex
+    try:
+        await resolver.resolve(domain, rdtype, deadline=deadline)
+    except dns.exception.DNSException:
+        pass
+
+
+def run(domain, components, deadline):
+    """Start the checks of components, returning {component: awaitable result}.
+
+    Components share apex answers through the resolver cache and in-flight
+    queries. Fan-out components wait for the apex first, so a domain that
+    does not exist settles their queries from the cache instead of the wire.
+    """
+    rdtype = apex_type(components)
+    apex = asyncio.ensure_future(_resolve_apex(domain, rdtype, deadline)) if rdtype else None
+
+    async def run_one(component):
+        if apex is not None and component in FAN_OUT_COMPONENTS:
+            await asyncio.shield(apex)
+        return await COMPONENTS[component][2](domain, deadline)
+
+    return {component: run_one(component) for component in components}
@@ -0,0 +1,269 @@
+import os
+import time
+import asyncio
+from functools import partial
+import dns.asyncresolver
+import dns.name
+import dns.resolver
+import dns.rdatatype
+import dns.exception
+import metrics
+import transport
+from limiter import AIMDLimiter, backoff
+from singleflight import SingleFlight
+from ttl_cache import TTLCache
+from utils import Deadline
+
+# Negative answers without an SOA in the authority section use this TTL
+DEFAULT_NEGATIVE_TTL = 300
+MAX_NEGATIVE_TTL = 3600
+# Upper bound (seconds) on a single query, retries included
+DNS_LIFETIME = float(os.environ.get("DNS_LIFETIME", "5"))
+# Extra attempts, after a jittered backoff, for queries every upstream answered with
+# SERVFAIL while backing off from overload (otherwise a SERVFAIL is the zone's own)
+DNS_RETRIES = int(os.environ.get("DNS_RETRIES", "2"))
+
+# Pseudo record type under which NXDOMAIN names are cached: nothing below
+# them exists either (RFC 8020), so their subdomains need no queries
+NXDOMAIN_CUT = "NXDOMAIN"
+
+_cache = TTLCache(maxsize=int(os.environ.get("DNS_CACHE_SIZE", "10000")))
+# Identical queries already on the wire are shared instead of sent again
+_flights = SingleFlight("dns")
+# Queries in flight through the system resolver configuration (the pooled
+# transport keeps one limiter per upstream instead)
+_limiter = AIMDLimiter("system", int(os.environ.get("DNS_INITIAL_CONCURRENCY", "32")),
+                       maximum=int(os.environ.get("DNS_MAX_CONCURRENCY", "512")))
+
+
+class DeadlineExceeded(dns.exception.Timeout):
+    """The query could not finish within the caller's time budget"""
+
+    msg = "Time budget exhausted"
+
+
+def _cache_key(qname, rdtype):
+    name = str(qname).lower().rstrip('.')
+    return (name, dns.rdatatype.to_text(dns.rdatatype.RdataType.make(rdtype)))
+
+
+def _negative_ttl(response):
+    if response is None:
+        return DEFAULT_NEGATIVE_TTL
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA and len(rrset):
+            return min(rrset.ttl, rrset[0].minimum, MAX_NEGATIVE_TTL)
+    return DEFAULT_NEGATIVE_TTL
+
+
+def _negative_response(error):
+    if isinstance(error, dns.resolver.NXDOMAIN):
+        responses = error.kwargs.get("responses") or {}
+        return next(iter(responses.values()), None)
+    return error.kwargs.get("response")
+
+
+def _outcome(error):
+    if isinstance(error, dns.resolver.NXDOMAIN):
+        return "nxdomain"
+    if isinstance(error, dns.resolver.NoAnswer):
+        return "nodata"
+    if isinstance(error, DeadlineExceeded):
+        return "deadline"
+    if isinstance(error, dns.exception.Timeout):
+        return "timeout"
+    if isinstance(error, asyncio.CancelledError):
+        return "cancelled"
+    return "error"
+
+
+def _nxdomain_cut(name):
+    """Cache key of an unexpired NXDOMAIN at an ancestor of name (RFC 8020), if any"""
+    labels = name.split('.')
+    now = time.time()
+    for i in range(1, len(labels) - 1):
+        key = ('.'.join(labels[i:]), NXDOMAIN_CUT)
+        expires_at = _cache.expires_at(key)
+        if expires_at and expires_at > now:
+            return key
+    return None
+
+
+async def _system_resolve(qname, rdtype, lifetime):
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(_limiter.acquire(), lifetime)
+    except asyncio.TimeoutError:
+        error = dns.resolver.LifetimeTimeout(timeout=lifetime, errors=[])
+        error.congestion = _limiter.congested
+        raise error from None
+    seconds = None
+    timed_out = False
+    acquired = time.monotonic()
+    try:
+        answer = await dns.asyncresolver.resolve(qname, rdtype, lifetime=max(lifetime - (acquired - started), 0))
+        seconds = time.monotonic() - acquired
+        return answer
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        seconds = time.monotonic() - acquired
+        raise
+    except dns.exception.Timeout as e:
+        seconds = time.monotonic() - acquired
+        timed_out = True
+        e.congestion = _limiter.congested
+        raise
+    except dns.exception.DNSException as e:
+        # SERVFAIL and the like: the zone's doing, which the limiter does not judge
+        e.congestion = _limiter.congested
+        raise
+    finally:
+        _limiter.release(seconds, timed_out)
+
+
+async def _resolve_with_retries(qname, rdtype, lifetime):
+    """Resolve within lifetime seconds, retrying SERVFAILs met while backing off"""
+    budget = Deadline(lifetime)
+    upstreams = transport.get_transport()
+    for attempt in range(DNS_RETRIES + 1):
+        try:
+            if upstreams is not None:
+                return await upstreams.resolve(qname, rdtype, budget.remaining())
+            return await _system_resolve(qname, rdtype, budget.remaining())
+        except dns.resolver.NoNameservers as e:
+            delay = backoff(attempt)
+            if not getattr(e, "congestion", False) or attempt == DNS_RETRIES or budget.remaining() <= delay:
+                raise
+            metrics.observe_retry("dns", "servfail")
+            await asyncio.sleep(delay)
+
+
+async def _query(key, qname, rdtype, lifetime, deadline):
+    deadline = Deadline.of(deadline)
+    lifetime = DNS_LIFETIME if lifetime is None else lifetime
+    budget = deadline.remaining(lifetime)
+    if budget <= 0:
+        raise DeadlineExceeded()
+
+    try:
+        answer = await _resolve_with_retries(qname, rdtype, budget)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+        response = _negative_response(e)
+        _cache.set(key, e, _negative_ttl(response))
+        # An NXDOMAIN reached through a CNAME is about the target, not qname
+        if isinstance(e, dns.resolver.NXDOMAIN) and response is not None and not response.answer:
+            _cache.set((key[0], NXDOMAIN_CUT), response, _negative_ttl(response))
+        raise
+    except dns.exception.Timeout as e:
+        if budget < lifetime:
+            error = DeadlineExceeded()
+            error.congestion = getattr(e, "congestion", False)
+            raise error from None
+        raise
+
+    _cache.set(key, answer, answer.expiration - time.time())
+    return answer
+
+
+async def resolve(qname, rdtype, lifetime=None, deadline=None):
+    """Resolve through the shared cache, caching NXDOMAIN/NODATA as well"""
+    started = time.perf_counter()
+    key = _cache_key(qname, rdtype)
+    cached = _cache.get(key)
+    if cached is None:
+        cut = _nxdomain_cut(key[0])
+        if cut:
+            name = dns.name.from_text(key[0])
+            cached = dns.resolver.NXDOMAIN(qnames=[name], responses={name: _cache.get(cut)})
+    outcome = "ok"
+    congestion = False
+    try:
+        if isinstance(cached, dns.exception.DNSException):
+            raise cached.with_traceback(None)
+        if cached is not None:
+            return cached
+        try:
+            return await _flights.do(key, partial(_query, key, qname, rdtype, lifetime, deadline))
+        except DeadlineExceeded:
+            # The shared query ran under another caller's tighter budget
+            if Deadline.of(deadline).expired:
+                raise
+            return await _query(key, qname, rdtype, lifetime, deadline)
+    except BaseException as e:
+        outcome = _outcome(e)
+        # Set on failures met while the limiter that served the query was backing off
+        congestion = getattr(e, "congestion", False)
+        raise
+    finally:
+        # The TTL lets callers work out how long a result built on this answer stays valid
+        ttl = remaining_ttl(qname, rdtype) if outcome in ("ok", "nxdomain", "nodata") else None
+        metrics.observe_dns(key[0], key[1], time.perf_counter() - started, outcome, cached is not None, ttl,
+                            congestion)
+
+
+def configure(nameservers=None, port=None, upstreams=None):
+    """Point the shared resolver at specific upstream servers, e.g. a local stub.
+
+    upstreams switches to the pooled transport (see transport.DNS_UPSTREAMS).
+    """
+    if upstreams is not None:
+        transport.configure(upstreams)
+    default = dns.asyncresolver.get_default_resolver()
+    if nameservers:
+        default.nameservers = list(nameservers)
+    if port:
+        default.port = port
+
+
+def remaining_ttl(qname, rdtype):
+    """Seconds until the cached answer (positive or negative) for qname expires"""
+    key = _cache_key(qname, rdtype)
+    expires_at = _cache.expires_at(key) or _cache.expires_at(_nxdomain_cut(key[0]))
+    return max(expires_at - time.time(), 0) if expires_at else 0
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _collect_cache_metrics():
+    stats = _cache.stats()
+    return [
+        ("dns_cache_hits", "counter", "Shared DNS cache hits", stats["hits"]),
+        ("dns_cache_misses", "counter", "Shared DNS cache misses", stats["misses"]),
+        ("dns_cache_evictions", "counter", "Shared DNS cache LRU evictions", stats["evictions"]),
+        ("dns_cache_entries", "gauge", "Entries held in the shared DNS cache", stats["size"]),
+    ]
+
+
+def _collect_limiter_metrics():
+    upstreams = transport.get_transport()
+    limiters = [u.limiter for u in upstreams.upstreams] if upstreams is not None else [_limiter]
+    return [
+        ("dns_concurrency_limit", "gauge", "Adaptive limit on DNS queries in flight, all upstreams",
+         round(sum(l.limit for l in limiters), 1)),
+        ("dns_queries_in_flight", "gauge", "DNS queries holding a limiter slot", sum(l.in_flight for l in limiters)),
+        ("dns_limit_decreases", "counter", "Times an upstream's concurrency limit was cut on overload",
+         sum(l.decreases for l in limiters)),
+    ]
+
+
+def _collect_transport_metrics():
+    upstreams = transport.get_transport()
+    if upstreams is None:
+        return []
+    stats = upstreams.stats
+    return [
+        ("dns_transport_queries", "counter", "Queries sent through the pooled transport", stats["queries"]),
+        ("dns_transport_truncated", "counter", "UDP answers truncated and retried over TCP", stats["truncated"]),
+        ("dns_transport_failovers", "counter", "Attempts moved to another upstream", stats["failovers"]),
+        ("dns_transport_failures", "counter", "Queries no upstream answered", stats["failures"]),
+    ]
+
+
+metrics.register_collector(_collect_cache_metrics)
+metrics.register_collector(_collect_transport_metrics)
+metrics.register_collector(_collect_limiter_metrics)
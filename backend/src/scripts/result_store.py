@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import threading
+
+# Unset disables the store; every check then runs in full
+RESULT_STORE_PATH = os.environ.get("RESULT_STORE_PATH")
+# Upper bound (seconds) on how long a stored result is reused, whatever the TTLs say
+MAX_RESULT_TTL = float(os.environ.get("RESULT_STORE_MAX_TTL", "86400"))
+# Results kept in memory before they are written out in one transaction...
+RESULT_STORE_BATCH = int(os.environ.get("RESULT_STORE_BATCH", "64"))
+# ...or at the first save after the oldest of them has waited this many seconds
+RESULT_STORE_FLUSH_INTERVAL = float(os.environ.get("RESULT_STORE_FLUSH_INTERVAL", "1"))
+
+# Query outcomes that say nothing about the zone, so the result must not be kept
+TRANSIENT_OUTCOMES = ("timeout", "deadline", "cancelled", "error")
+
+_store = None
+
+
+class ResultStore:
+    """Component results keyed by (domain, component), valid until their DNS data expires.
+
+    load() and flush() block on SQLite, so async callers run them in a thread;
+    save() only queues the row for the next flush().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        # WAL lets every worker process read while another one writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " domain TEXT NOT NULL,"
+            " component TEXT NOT NULL,"
+            " result TEXT NOT NULL,"
+            " checked_at REAL NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " PRIMARY KEY (domain, component))")
+        # The connection is shared by the threads calling load() and flush()
+        self._db_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # (domain, component): (result JSON, checked_at, expires_at) not written yet
+        self._pending = {}
+        self._pending_since = None
+
+    def load(self, domain, components):
+        """Return {component: (result, checked_at, expires_at)} for unexpired rows"""
+        domain = domain.lower()
+        now = time.time()
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT component, result, checked_at, expires_at FROM results"
+                " WHERE domain = ? AND expires_at > ?", (domain, now)).fetchall()
+        with self._lock:
+            rows += [(component, *self._pending[(domain, component)]) for component in components
+                     if (domain, component) in self._pending]
+        return {component: (json.loads(result), checked_at, expires_at)
+                for component, result, checked_at, expires_at in rows
+                if component in components and expires_at > now}
+
+    def save(self, domain, component, result, ttl):
+        """Queue a result for the next flush(); returns whether one is due"""
+        now = time.time()
+        with self._lock:
+            if ttl > 0:
+                self._pending[(domain.lower(), component)] = (
+                    json.dumps(result), now, now + min(ttl, MAX_RESULT_TTL))
+                if self._pending_since is None:
+                    self._pending_since = now
+            return bool(self._pending) and (len(self._pending) >= RESULT_STORE_BATCH or
+                                            now - self._pending_since >= RESULT_STORE_FLUSH_INTERVAL)
+
+    def flush(self):
+        """Write the queued results in one transaction"""
+        with self._lock:
+            pending, self._pending, self._pending_since = self._pending, {}, None
+        if not pending:
+            return
+        with self._db_lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results (domain, component, result, checked_at, expires_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(domain, component, *row) for (domain, component), row in pending.items()])
+
+    def purge(self):
+        with self._db_lock:
+            self._db.execute("DELETE FROM results WHERE expires_at <= ?", (time.time(),))
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def result_ttl(result, events):
+    """Seconds a component result stays valid: the shortest TTL of the answers it used.
+
+    Timeouts, partial results and answers hit by transient failures return 0,
+    as does a result built without any DNS answer to bound it.
+    """
+    if result.get("status") == "timeout" or result.get("partial"):
+        return 0
+    ttls = []
+    for event in events:
+        if event["type"] == "dns" and event["outcome"] in TRANSIENT_OUTCOMES:
+            return 0
+        if "ttl" in event:
+            ttls.append(event["ttl"])
+    return max(min(ttls, default=0), 0)
+
+
+def configure(path):
+    """Open the store at path, or disable it when path is empty"""
+    global _store, RESULT_STORE_PATH
+    if _store is not None:
+        _store.close()
+    RESULT_STORE_PATH = path
+    _store = ResultStore(path) if path else None
+
+
+def get_store():
+    if _store is None and RESULT_STORE_PATH:
+        configure(RESULT_STORE_PATH)
+    return _store
+
+
+@atexit.register
+def _close():
+    # Results still queued would otherwise be lost with the process
+    if _store is not None:
+        _store.close()
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import result_store
+from bulk import run_bulk
+
+# Written once per output directory; a resumed scan must keep its input and shard count
+MANIFEST = "scan.json"
+
+
+def shard_of(domain, shards):
+    # Stable across processes and runs, unlike hash()
+    return zlib.crc32(domain.lower().encode()) % shards
+
+
+def _shard_path(out_dir, shard, suffix):
+    return os.path.join(out_dir, f"shard-{shard:04d}.{suffix}")
+
+
+def _load_journal(path):
+    try:
+        with open(path) as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def _drop_torn_line(path):
+    # A process killed mid-write leaves half a record at the end of its output
+    try:
+        with open(path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+    except FileNotFoundError:
+        pass
+
+
+class _ShardStream:
+    """The lines of a domain list that fall in one shard and are not journaled yet"""
+
+    def __init__(self, stream, shard, shards, done):
+        self._stream = stream
+        self.shard = shard
+        self.shards = shards
+        self.done = done
+        self.queued = 0
+        self.skipped = 0
+
+    def readline(self):
+        for line in self._stream:
+            domain = line.strip()
+            if not domain or domain.startswith('#') or shard_of(domain, self.shards) != self.shard:
+                continue
+            if domain in self.done:
+                self.skipped += 1
+                continue
+            self.queued += 1
+            return line
+        return ""
+
+
+def _scan_shard(path, out_dir, shard, shards, concurrency, store_path, options):
+    """Check one shard of path in this process, appending to its output and journal"""
+    from main import check_domain_async
+
+    if store_path:
+        result_store.configure(store_path)
+    output = _shard_path(out_dir, shard, "ndjson")
+    journal_path = _shard_path(out_dir, shard, "journal")
+    _drop_torn_line(output)
+    started = time.monotonic()
+
+    async def check(domain):
+        return await check_domain_async(domain, **options)
+
+    with open(path) as source, open(output, "a") as out, open(journal_path, "a") as journal:
+        stream = _ShardStream(source, shard, shards, _load_journal(journal_path))
+        asyncio.run(run_bulk(stream, check, concurrency, out=out, journal=journal))
+    store = result_store.get_store()
+    if store is not None:
+        store.flush()
+    return {"shard": shard, "checked": stream.queued, "skipped": stream.skipped,
+            "elapsed_s": round(time.monotonic() - started, 2)}
+
+
+def _load_manifest(path, out_dir, shards):
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {"input": os.path.abspath(path), "shards": shards or os.cpu_count() or 1}
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        return manifest
+
+    if manifest["input"] != os.path.abspath(path):
+        raise ValueError(f"{out_dir} holds a scan of {manifest['input']}")
+    if shards and shards != manifest["shards"]:
+        raise ValueError(f"{out_dir} was scanned with {manifest['shards']} shards")
+    return manifest
+
+
+def run_scan(path, out_dir, shards=None, processes=None, concurrency=None, store_path=None, **options):
+    """Check every domain listed in path across a pool of processes.
+
+    Domains are split into shards by a hash of their name; each shard is
+    checked by one process running the bulk loop and writes
+    shard-NNNN.ndjson and shard-NNNN.journal under out_dir. Running the
+    same scan again skips journaled domains, so an interrupted scan resumes
+    where it stopped; a domain in flight at the interruption is checked
+    again and may appear twice. options go to check_domain_async().
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shards = _load_manifest(path, out_dir, shards)["shards"]
+    processes = min(processes or os.cpu_count() or 1, shards)
+    started = time.monotonic()
+
+    # Spawned, not forked: each worker opens its own sockets and SQLite handle
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        futures = [pool.submit(_scan_shard, path, out_dir, shard, shards, concurrency, store_path, options)
+                   for shard in range(shards)]
+        results = [future.result() for future in futures]
+
+    return {
+        "shards": shards,
+        "processes": processes,
+        "checked": sum(r["checked"] for r in results),
+        "skipped": sum(r["skipped"] for r in results),
+        "elapsed_s": round(time.monotonic() - started, 2),
+    }
@@ -0,0 +1,185 @@
+import os
+import atexit
+import sqlite3
+import threading
+import zlib
+
+# Unset keeps the index in memory: it still learns, but only for this process
+DKIM_INDEX_PATH = os.environ.get("DKIM_INDEX_PATH")
+# Checks counted in memory before they are written out in one transaction
+DKIM_INDEX_BATCH = int(os.environ.get("DKIM_INDEX_BATCH", "32"))
+
+# Row holding the totals across every provider
+GLOBAL = "*"
+
+# MX host suffix: (provider, selectors that provider's customers usually publish)
+PROVIDERS = {
+    "google.com": ("google", ["google"]),
+    "googlemail.com": ("google", ["google"]),
+    "mail.protection.outlook.com": ("microsoft", ["selector1", "selector2"]),
+    "zoho.com": ("zoho", ["zoho", "zmail"]),
+    "zoho.eu": ("zoho", ["zoho", "zmail"]),
+    "messagingengine.com": ("fastmail", ["fm1", "fm2", "fm3"]),
+    "protonmail.ch": ("proton", ["protonmail", "protonmail2", "protonmail3"]),
+    "yahoodns.net": ("yahoo", ["s1024", "s2048"]),
+    "mail.icloud.com": ("icloud", ["sig1"]),
+    "mimecast.com": ("mimecast", ["mimecast20190104", "mimecast20230622"]),
+    "pphosted.com": ("proofpoint", ["proofpoint"]),
+    "mailgun.org": ("mailgun", ["mx", "k1", "smtp", "pic"]),
+    "ovh.net": ("ovh", ["ovhmo"]),
+    "yandex.net": ("yandex", ["mail"]),
+}
+
+_index = None
+
+
+def infer_provider(mx_hosts):
+    """Return (provider, selector hints) for the most preferred MX host.
+
+    Hosts of unknown providers are grouped by their last two labels, so that
+    domains sharing a mail host still learn from each other.
+    """
+    if not mx_hosts:
+        return None, []
+    host = mx_hosts[0].lower().rstrip('.')
+    for suffix, (provider, hints) in PROVIDERS.items():
+        if host == suffix or host.endswith('.' + suffix):
+            return provider, hints
+    return '.'.join(host.split('.')[-2:]), []
+
+
+class SelectorIndex:
+    """How often each DKIM selector was found, overall and per mail provider.
+
+    Ranking reads counts held in memory; recorded checks reach SQLite in
+    batches through flush(), which blocks and so belongs off the event loop.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._db = sqlite3.connect(path or ":memory:", isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS selector_hits ("
+            " provider TEXT NOT NULL,"
+            " selector TEXT NOT NULL,"
+            " hits INTEGER NOT NULL,"
+            " PRIMARY KEY (provider, selector))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS provider_checks ("
+            " provider TEXT PRIMARY KEY,"
+            " checks INTEGER NOT NULL)")
+        # Guards the counts below; the connection is only used under _write_lock
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # provider: [checks, {selector: hits}] recorded but not written yet
+        self._pending = {}
+        # provider: {selector: hits}, stored and pending together
+        self._hits = self._load()
+
+    def _load(self):
+        hits = {}
+        for provider, selector, count in self._db.execute("SELECT provider, selector, hits FROM selector_hits"):
+            hits.setdefault(provider, {})[selector] = count
+        return hits
+
+    def rank(self, candidates, provider=None, hints=(), limit=None, explore=0, exclude=(), domain=""):
+        """Pick up to limit candidates to probe: hints, then those found before
+        for provider, then overall, then up to explore never found.
+
+        The selectors explored are picked by domain, so that checks of one
+        domain probe the same ones while checks across domains cover them all.
+        Selectors the index has seen hit for provider are candidates too;
+        those in exclude (probed anyway) never are.
+        """
+        with self._lock:
+            provider_hits = dict(self._hits.get(provider, {})) if provider else {}
+            global_hits = dict(self._hits.get(GLOBAL, {}))
+        selectors = [s for s in dict.fromkeys([*provider_hits, *candidates]) if s not in exclude]
+        seen = sorted((s for s in selectors if s in global_hits or s in provider_hits),
+                      key=lambda s: (-provider_hits.get(s, 0), -global_hits.get(s, 0)))
+        ranked = list(dict.fromkeys([*(h for h in hints if h not in exclude), *seen]))
+        if limit is not None:
+            ranked = ranked[:max(limit - explore, 0)]
+        # A selector never probed can never be found, and so never ranked
+        unseen = [s for s in selectors if s not in ranked and s not in global_hits]
+        start = zlib.crc32(domain.lower().encode()) % len(unseen) if unseen else 0
+        return ranked + (unseen[start:] + unseen[:start])[:explore]
+
+    def record(self, provider, selectors):
+        """Count one completed check of a domain at provider that found selectors.
+
+        Returns how many recorded checks are waiting for flush().
+        """
+        with self._lock:
+            for p in [GLOBAL] + ([provider] if provider else []):
+                pending = self._pending.setdefault(p, [0, {}])
+                pending[0] += 1
+                hits = self._hits.setdefault(p, {})
+                for selector in selectors:
+                    pending[1][selector] = pending[1].get(selector, 0) + 1
+                    hits[selector] = hits.get(selector, 0) + 1
+            return self._pending[GLOBAL][0]
+
+    def flush(self):
+        """Write the pending counts in one transaction and pick up other processes' counts"""
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if pending:
+                with self._db:
+                    self._db.execute("BEGIN IMMEDIATE")
+                    for p, (checks, hits) in pending.items():
+                        self._db.execute(
+                            "INSERT INTO provider_checks (provider, checks) VALUES (?, ?)"
+                            " ON CONFLICT (provider) DO UPDATE SET checks = checks + excluded.checks",
+                            (p, checks))
+                        for selector, count in hits.items():
+                            self._db.execute(
+                                "INSERT INTO selector_hits (provider, selector, hits) VALUES (?, ?, ?)"
+                                " ON CONFLICT (provider, selector) DO UPDATE SET hits = hits + excluded.hits",
+                                (p, selector, count))
+            stored = self._load()
+            with self._lock:
+                # Checks recorded while writing are not in the table yet
+                for p, (_, hits) in self._pending.items():
+                    for selector, count in hits.items():
+                        stored.setdefault(p, {})[selector] = stored.get(p, {}).get(selector, 0) + count
+                self._hits = stored
+
+    def stats(self, provider=GLOBAL):
+        """{"checks": n, "hit_rates": {selector: fraction of checks it was found in}}"""
+        self.flush()
+        with self._write_lock:
+            row = self._db.execute("SELECT checks FROM provider_checks WHERE provider = ?", (provider,)).fetchone()
+            hits = dict(self._db.execute("SELECT selector, hits FROM selector_hits WHERE provider = ?", (provider,)))
+        checks = row[0] if row else 0
+        return {"checks": checks,
+                "hit_rates": {s: count / checks for s, count in hits.items()} if checks else {}}
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def configure(path):
+    """Open the index at path, or keep it in memory when path is empty"""
+    global _index, DKIM_INDEX_PATH
+    if _index is not None:
+        _index.close()
+    DKIM_INDEX_PATH = path
+    _index = SelectorIndex(path)
+
+
+def get_index():
+    if _index is None:
+        configure(DKIM_INDEX_PATH)
+    return _index
+
+
+@atexit.register
+def _close():
+    # Counts still pending would otherwise be lost with the process
+    if _index is not None:
+        _index.close()
@@ -0,0 +1,31 @@
+import asyncio
+import metrics
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its outcome"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self._calls = {}
+
+    def _done(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # Mark the exception retrieved even when every caller has gone away
+        if not future.cancelled():
+            future.exception()
+
+    async def do(self, key, factory):
+        future = self._calls.get(key)
+        metrics.observe_flight(self.kind, joined=future is not None)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        # One caller giving up (deadline, cancellation) must not cancel the
+        # call for everyone else waiting on it
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,333 @@
+import os
+import json
+import asyncio
+import ipaddress
+from bisect import bisect_right, insort
+import dns.resolver
+import dns.exception
+import resolver
+from spf_graph import graph
+from ttl_cache import TTLCache
+
+QUALIFIERS = {'+': "pass", '-': "fail", '~': "softfail", '?': "neutral"}
+ERRORS = ("permerror", "temperror")
+MAX_LOOKUPS = 10
+MAX_MX_HOSTS = 10
+
+_compiled = TTLCache(maxsize=int(os.environ.get("SPF_EVAL_CACHE_SIZE", "5000")))
+
+
+class _SPFError(Exception):
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class _RangeIndex:
+    """Disjoint, sorted address ranges labelled with an SPF result"""
+
+    def __init__(self):
+        self.starts = []
+        self.ranges = []
+
+    def assign(self, start, end, label):
+        """Label the parts of [start, end] that no earlier mechanism matched"""
+        i = max(bisect_right(self.starts, start) - 1, 0)
+        cursor = start
+        pieces = []
+        for range_start, range_end, _ in self.ranges[i:]:
+            if range_start > end:
+                break
+            if range_end < cursor:
+                continue
+            if range_start > cursor:
+                pieces.append((cursor, range_start - 1))
+            cursor = max(cursor, range_end + 1)
+            if cursor > end:
+                break
+        if cursor <= end:
+            pieces.append((cursor, end))
+
+        for piece_start, piece_end in pieces:
+            insort(self.ranges, (piece_start, piece_end, label))
+            insort(self.starts, piece_start)
+
+    def gaps(self, start, end):
+        """Yield the (start, end) pieces of [start, end] that carry no label"""
+        cursor = start
+        for range_start, range_end, _ in self.ranges:
+            if range_end < cursor:
+                continue
+            if range_start > end:
+                break
+            if range_start > cursor:
+                yield cursor, range_start - 1
+            cursor = range_end + 1
+        if cursor <= end:
+            yield cursor, end
+
+    def lookup(self, address):
+        i = bisect_right(self.starts, address) - 1
+        if i >= 0 and self.ranges[i][1] >= address:
+            return self.ranges[i][2]
+        return None
+
+
+# Highest address of each family, for the ranges a policy's default covers
+_MAX_ADDRESS = {4: 2 ** 32 - 1, 6: 2 ** 128 - 1}
+
+
+class CompiledSPF:
+    """A domain's SPF policy flattened into per-family address range indexes.
+
+    Building it resolves every include, redirect, a and mx term once; after
+    that an IP is evaluated with a binary search and no DNS traffic.
+    """
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.indexes = {4: _RangeIndex(), 6: _RangeIndex()}
+        self.default = None
+        self.error = None
+        self.lookup_count = 0
+        self.unsupported = []
+
+    def assign(self, network, label):
+        start = int(network.network_address)
+        end = int(network.broadcast_address)
+        self.indexes[network.version].assign(start, end, label)
+
+    def evaluate(self, ip):
+        """Return the check_host() result for one IP address"""
+        if self.error:
+            return self.error
+        address = ipaddress.ip_address(ip)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        return self.indexes[address.version].lookup(int(address)) or self.default
+
+    def evaluate_many(self, ips):
+        """Evaluate a batch of IPs; unparsable entries yield "invalid"."""
+        seen = {}
+        results = []
+        for ip in ips:
+            result = seen.get(ip)
+            if result is None:
+                try:
+                    result = self.evaluate(ip)
+                except ValueError:
+                    result = "invalid"
+                seen[ip] = result
+            results.append(result)
+        return results
+
+
+def _split_term(term):
+    qualifier = term[0] if term[0] in QUALIFIERS else '+'
+    term = term[1:] if term[0] in QUALIFIERS else term
+    return QUALIFIERS[qualifier], term.lower()
+
+
+def _parse_dual_cidr(spec, domain):
+    """Split 'a:host/24//64' style arguments into (domain, cidr4, cidr6)"""
+    cidr6 = 128
+    if '//' in spec:
+        spec, cidr6 = spec.split('//', 1)
+        cidr6 = int(cidr6)
+    cidr4 = 32
+    if '/' in spec:
+        spec, cidr4 = spec.split('/', 1)
+        cidr4 = int(cidr4)
+    target = spec[1:] if spec.startswith(':') else domain
+    return target or domain, cidr4, cidr6
+
+
+async def _addresses(name, ttls, rdtypes=('A', 'AAAA')):
+    answers = []
+    for rdtype in rdtypes:
+        try:
+            answers.extend(str(r) for r in await resolver.resolve(name, rdtype))
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            pass
+        except dns.exception.DNSException:
+            raise _SPFError("temperror")
+        finally:
+            # 0 for a failed lookup, which keeps the policy out of the cache
+            ttls.append(resolver.remaining_ttl(name, rdtype))
+    return answers
+
+
+async def _host_networks(hosts, cidr4, cidr6, ttls):
+    host_addresses = await asyncio.gather(*(_addresses(h, ttls) for h in hosts))
+    for addresses in host_addresses:
+        for address in addresses:
+            ip = ipaddress.ip_address(address)
+            prefix = cidr4 if ip.version == 4 else cidr6
+            yield ipaddress.ip_network(f"{address}/{prefix}", strict=False)
+
+
+async def _mx_hosts(name, ttls):
+    try:
+        answers = await resolver.resolve(name, 'MX')
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        return []
+    except dns.exception.DNSException:
+        raise _SPFError("temperror")
+    finally:
+        ttls.append(resolver.remaining_ttl(name, 'MX'))
+    hosts = sorted(answers, key=lambda r: r.preference)[:MAX_MX_HOSTS]
+    return [str(r.exchange).rstrip('.') for r in hosts]
+
+
+async def _spf_record(domain, ttls):
+    try:
+        answers = await resolver.resolve(domain, 'TXT')
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        return None
+    except dns.exception.DNSException:
+        raise _SPFError("temperror")
+    finally:
+        ttls.append(resolver.remaining_ttl(domain, 'TXT'))
+    records = [str(r).strip('"') for r in answers]
+    records = [''.join(r.split('" "')) for r in records if r.startswith('v=spf1')]
+    if len(records) > 1:
+        raise _SPFError("permerror")
+    return records[0] if records else None
+
+
+async def _compile_into(policy, domain, stack, ttls):
+    """Add domain's mechanisms to policy; return the result for unmatched IPs"""
+    if domain in stack:
+        return "permerror"
+    stack = stack + (domain,)
+
+    try:
+        record = await _spf_record(domain, ttls)
+    except _SPFError as e:
+        return e.result
+    if record is None:
+        return "permerror"
+
+    redirect = None
+    for term in record.split()[1:]:
+        result, mechanism = _split_term(term)
+        try:
+            if '%' in mechanism:
+                policy.unsupported.append(term)
+            elif mechanism.startswith('redirect='):
+                redirect = mechanism[9:]
+            elif '=' in mechanism:
+                continue
+            elif mechanism == 'all':
+                return result
+            elif mechanism.startswith(('ip4:', 'ip6:')):
+                policy.assign(ipaddress.ip_network(mechanism[4:], strict=False), result)
+            elif mechanism == 'a' or mechanism.startswith(('a:', 'a/')):
+                target, cidr4, cidr6 = _parse_dual_cidr(mechanism[1:], domain)
+                async for network in _host_networks([target], cidr4, cidr6, ttls):
+                    policy.assign(network, result)
+            elif mechanism == 'mx' or mechanism.startswith(('mx:', 'mx/')):
+                target, cidr4, cidr6 = _parse_dual_cidr(mechanism[2:], domain)
+                hosts = await _mx_hosts(target, ttls)
+                async for network in _host_networks(hosts, cidr4, cidr6, ttls):
+                    policy.assign(network, result)
+            elif mechanism.startswith('exists:'):
+                # An A query whatever the connecting IP's family (RFC 7208 5.7)
+                if await _addresses(mechanism[7:], ttls, ('A',)):
+                    return result
+            elif mechanism.startswith('include:'):
+                await _compile_include(policy, mechanism[8:], result, stack, ttls)
+            else:
+                # ptr and unknown mechanisms depend on the connecting IP or are
+                # not defined, so they cannot be flattened into the index
+                policy.unsupported.append(term)
+        except ValueError:
+            return "permerror"
+        except _SPFError as e:
+            return e.result
+
+    if redirect:
+        return await _compile_into(policy, redirect, stack, ttls)
+    return None
+
+
+def _include_label(child_result, result):
+    """What an IP gets from include: given its result under the included policy
+    (RFC 7208 5.2): pass matches, errors propagate, anything else falls through"""
+    if child_result == "pass":
+        return result
+    if child_result in ERRORS:
+        return child_result
+    return None
+
+
+async def _compile_include(policy, include_domain, result, stack, ttls):
+    """Merge an include into policy's indexes; IPs it does not match stay unlabelled"""
+    child = CompiledSPF(include_domain)
+    child.default = await _compile_into(child, include_domain, stack, ttls)
+    policy.unsupported.extend(child.unsupported)
+
+    default = _include_label(child.default, result)
+    for version, index in child.indexes.items():
+        # The child's default only covers the addresses its terms left
+        # unlabelled; collect them before labelling the parent
+        gaps = list(index.gaps(0, _MAX_ADDRESS[version])) if default else []
+        for start, end, label in index.ranges:
+            label = _include_label(label, result)
+            if label:
+                policy.indexes[version].assign(start, end, label)
+        for start, end in gaps:
+            policy.indexes[version].assign(start, end, default)
+
+
+async def compile_spf_async(domain):
+    key = domain.lower().rstrip('.')
+    cached = _compiled.get(key)
+    if cached is not None:
+        return cached
+
+    policy = CompiledSPF(domain)
+    ttls = []
+    try:
+        record = await _spf_record(domain, ttls)
+    except _SPFError as e:
+        policy.error = e.result
+        return policy
+    if record is None:
+        policy.error = "none"
+        return policy
+
+    _, policy.lookup_count, _ = await graph.analyze(record, domain)
+    if policy.lookup_count > MAX_LOOKUPS:
+        policy.error = "permerror"
+    else:
+        policy.default = await _compile_into(policy, domain, (), ttls) or "neutral"
+
+    if policy.default != "temperror":
+        _compiled.set(key, policy, min(ttls, default=0))
+    return policy
+
+
+def compile_spf(domain):
+    return asyncio.run(compile_spf_async(domain))
+
+
+async def check_host_async(ip, domain):
+    return (await compile_spf_async(domain)).evaluate(ip)
+
+
+def check_host(ip, domain):
+    return asyncio.run(check_host_async(ip, domain))
+
+
+async def run_check_host(domain, stream, out, batch_size=10000):
+    """Evaluate one IP per line from stream, writing NDJSON results to out"""
+    policy = await compile_spf_async(domain)
+    while True:
+        batch = [line.strip() for line in stream.readlines(batch_size * 16)]
+        if not batch:
+            break
+        ips = [ip for ip in batch if ip]
+        for ip, result in zip(ips, policy.evaluate_many(ips)):
+            out.write(json.dumps({"ip": ip, "result": result}) + "\n")
+        out.flush()
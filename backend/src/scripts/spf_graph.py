@@ -0,0 +1,171 @@
+import os
+import time
+import asyncio
+import contextvars
+from functools import partial
+import dns.resolver
+import dns.exception
+import metrics
+import resolver
+from singleflight import SingleFlight
+from ttl_cache import TTLCache
+
+MAX_DEPTH = 10
+
+# Subtree whose build the current task runs, if any
+_building = contextvars.ContextVar("spf_subtree_building", default=None)
+
+
+async def _fetch_spf_record(domain, deadline=None):
+    """Return (record, settled); settled is False when the lookup itself failed"""
+    try:
+        answers = await resolver.resolve(domain, 'TXT', deadline=deadline)
+        for rdata in answers:
+            record = str(rdata).strip('"')
+            if record.startswith('v=spf1'):
+                return record, True
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        pass
+    except dns.exception.DNSException:
+        return None, False
+    return None, True
+
+
+async def get_spf_record(domain, deadline=None):
+    record, _ = await _fetch_spf_record(domain, deadline)
+    return record
+
+
+def _lookup(lookup_type, domain, mechanism):
+    return {"type": lookup_type, "domain": domain, "mechanism": mechanism}
+
+
+def _parse_mechanism(mechanism, domain):
+    """Return (lookup_type, target_domain) for mechanisms that cost a DNS lookup"""
+    if mechanism.startswith('include:'):
+        return "include", mechanism[8:]
+    if mechanism.startswith(('a:', 'mx:')):
+        lookup_type = mechanism[0:2].rstrip(':')
+        return lookup_type, mechanism[len(lookup_type)+1:]
+    if mechanism in ['a', 'mx']:
+        return mechanism, domain
+    if mechanism.startswith('exists:'):
+        return "exists", mechanism[7:]
+    if mechanism.startswith('redirect='):
+        return "redirect", mechanism[9:]
+    return None, None
+
+
+class SPFGraph:
+    """Walks SPF include/redirect graphs, memoizing each subtree across domains.
+
+    A subtree is keyed by the include domain and kept until the shortest TTL of
+    the TXT records it was built from expires, so a batch of domains sharing
+    the same mail providers only walks each provider's tree once.
+    """
+
+    def __init__(self, maxsize=5000):
+        self._subtrees = TTLCache(maxsize)
+        self._flights = SingleFlight("spf_subtree")
+        # Subtree being built: the subtrees its walk is waiting for
+        self._waits = {}
+
+    async def analyze(self, spf_record, domain, deadline=None):
+        """Return (lookups, count, complete) for the tree rooted at spf_record"""
+        lookups, count, _, complete = await self._walk(spf_record, domain, (), 0, deadline)
+        return lookups, count, complete
+
+    async def _subtree(self, domain, stack, depth, deadline):
+        key = domain.lower().rstrip('.')
+        cached = self._subtrees.get(key)
+        if cached is not None:
+            metrics.observe_memo("spf_subtree", key, self._subtrees.expires_at(key) - time.time())
+            return cached
+
+        # Walks from every domain share one build per subtree. A build joining
+        # one that (indirectly) waits for it would wait on itself: that is an
+        # include loop reached from two domains at once.
+        waiter = _building.get()
+        if waiter is not None:
+            if self._waits_for(key, waiter):
+                return [], 0, float('inf'), False
+            self._waits.setdefault(waiter, set()).add(key)
+        try:
+            return await self._flights.do(key, partial(self._build_subtree, key, domain, stack, depth, deadline))
+        finally:
+            if waiter is not None:
+                self._waits.get(waiter, set()).discard(key)
+
+    def _waits_for(self, key, other):
+        """Whether the build of key is waiting, through others, for the build of other"""
+        seen = set()
+        pending = [key]
+        while pending:
+            current = pending.pop()
+            if current == other:
+                return True
+            if current not in seen:
+                seen.add(current)
+                pending.extend(self._waits.get(current, ()))
+        return False
+
+    async def _build_subtree(self, key, domain, stack, depth, deadline):
+        _building.set(key)
+        try:
+            record, settled = await _fetch_spf_record(domain, deadline)
+            ttl = resolver.remaining_ttl(domain, 'TXT')
+            if not record:
+                subtree = ([], 0, ttl, settled)
+            else:
+                lookups, count, child_ttl, complete = await self._walk(record, domain, stack, depth, deadline)
+                subtree = (lookups, count, min(ttl, child_ttl), complete)
+        finally:
+            self._waits.pop(key, None)
+
+        # Subtrees cut short by a loop, the depth limit or a failed lookup are
+        # not the zone's real answer, so only complete ones are shared
+        if subtree[3]:
+            self._subtrees.set(key, subtree, subtree[2])
+        return subtree
+
+    async def _walk(self, spf_record, domain, stack, depth, deadline):
+        if domain in stack or depth > MAX_DEPTH:
+            return [], 0, float('inf'), False
+
+        stack = stack + (domain,)
+        mechanisms = [_parse_mechanism(m.lower(), domain) + (m.lower(),)
+                      for m in spf_record.split()]
+
+        # Fetch every nested record of this level at once; the walk below then
+        # runs in mechanism order so the lookup list matches RFC evaluation order
+        nested = [target for lookup_type, target, _ in mechanisms
+                  if lookup_type in ("include", "redirect")]
+        await asyncio.gather(*(get_spf_record(target, deadline) for target in dict.fromkeys(nested)))
+
+        lookups = []
+        total_count = 0
+        ttl = float('inf')
+        complete = True
+        for lookup_type, target, mechanism in mechanisms:
+            if not lookup_type:
+                continue
+            lookups.append(_lookup(lookup_type, target, mechanism))
+            total_count += 1
+            if lookup_type in ("include", "redirect"):
+                nested_lookups, nested_count, nested_ttl, nested_complete = await self._subtree(
+                    target, stack, depth + 1, deadline)
+                lookups.extend(nested_lookups)
+                total_count += nested_count
+                ttl = min(ttl, nested_ttl)
+                complete = complete and nested_complete
+
+        return lookups, total_count, ttl, complete
+
+    def stats(self):
+        return self._subtrees.stats()
+
+    def clear(self):
+        self._subtrees.clear()
+
+
+graph = SPFGraph(maxsize=int(os.environ.get("SPF_GRAPH_CACHE_SIZE", "5000")))
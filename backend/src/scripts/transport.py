@@ -0,0 +1,404 @@
+import os
+import ssl
+import socket
+import time
+import random
+import asyncio
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+from limiter import AIMDLimiter, backoff
+
+# Comma-separated upstream resolvers: "host", "host:port" or "tls://host[:port][#server-name]".
+# Unset leaves resolution to dnspython and the system resolver configuration.
+DNS_UPSTREAMS = os.environ.get("DNS_UPSTREAMS", "")
+# Long-lived UDP sockets per upstream; every outstanding query shares them
+UDP_SOCKETS = int(os.environ.get("DNS_UDP_SOCKETS", "4"))
+UDP_RECEIVE_BUFFER = 4 * 1024 * 1024
+# Timeout (seconds) for one attempt against one upstream before failing over
+ATTEMPT_TIMEOUT = float(os.environ.get("DNS_ATTEMPT_TIMEOUT", "2"))
+# EDNS payload advertised over UDP; larger answers come back truncated and move to TCP
+EDNS_PAYLOAD = 1232
+# Consecutive failures after which an upstream is skipped for UPSTREAM_BACKOFF seconds
+MAX_FAILURES = 3
+UPSTREAM_BACKOFF = 5.0
+# Queries in flight per upstream to start from, and the most it may grow to;
+# the limit adapts to the upstream's error rate and latency in between
+DNS_INITIAL_CONCURRENCY = int(os.environ.get("DNS_INITIAL_CONCURRENCY", "32"))
+DNS_MAX_CONCURRENCY = int(os.environ.get("DNS_MAX_CONCURRENCY", "512"))
+
+_transport = None
+
+
+class _Pending:
+    """Outstanding queries of one socket or connection, matched by message ID"""
+
+    def __init__(self):
+        self._queries = {}
+
+    def __len__(self):
+        return len(self._queries)
+
+    def add(self, query):
+        while True:
+            query.id = random.randint(0, 0xFFFF)
+            if query.id not in self._queries:
+                break
+        future = asyncio.get_running_loop().create_future()
+        self._queries[query.id] = (query, future)
+        return future
+
+    def discard(self, query):
+        entry = self._queries.get(query.id)
+        if entry and entry[0] is query:
+            del self._queries[query.id]
+
+    def resolve(self, wire):
+        try:
+            response = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            return
+        entry = self._queries.get(response.id)
+        # An ID match alone could be a late or spoofed reply to another question
+        if entry and entry[0].is_response(response):
+            del self._queries[response.id]
+            if not entry[1].done():
+                entry[1].set_result(response)
+
+    def fail(self, error):
+        for _, future in self._queries.values():
+            if not future.done():
+                future.set_exception(error)
+        self._queries.clear()
+
+
+class _UDPSocket:
+    """A connected, non-blocking UDP socket shared by many outstanding queries"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = _Pending()
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(sock.fileno(), self._drain)
+
+    @classmethod
+    async def open(cls, host, port):
+        loop = asyncio.get_running_loop()
+        family, _, _, _, address = (await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM))[0]
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        # Answers to hundreds of outstanding queries can arrive in one burst;
+        # the default buffer would drop them and turn them into timeouts
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER)
+        sock.connect(address)
+        return cls(sock)
+
+    def _drain(self):
+        # Read every queued datagram per wakeup: asyncio's datagram transport
+        # reads one, leaving the rest to wait behind expiring timeouts
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable: nothing listens upstream
+                self.pending.fail(e)
+                return
+            self.pending.resolve(data)
+
+    async def query(self, query):
+        future = self.pending.add(query)
+        try:
+            await self._loop.sock_sendall(self.sock, query.to_wire())
+            return await future
+        finally:
+            self.pending.discard(query)
+
+    def close(self):
+        if not self._loop.is_closed():
+            self._loop.remove_reader(self.sock.fileno())
+            self.pending.fail(ConnectionError("UDP socket closed"))
+        self.sock.close()
+
+
+class _StreamConnection:
+    """A persistent TCP or DNS-over-TLS connection carrying pipelined queries"""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.pending = _Pending()
+        self._writer = None
+        self._reader_task = None
+        self._loop = None
+        self._connecting = asyncio.Lock()
+
+    async def _connect(self):
+        upstream = self.upstream
+        self._loop = asyncio.get_running_loop()
+        context = ssl.create_default_context() if upstream.tls else None
+        reader, self._writer = await asyncio.open_connection(
+            upstream.host, upstream.port, ssl=context,
+            server_hostname=(upstream.server_name or upstream.host) if upstream.tls else None)
+        self._reader_task = asyncio.create_task(self._read(reader, self._writer))
+
+    async def _read(self, reader, writer):
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                self.pending.resolve(await reader.readexactly(length))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            # The server closed an idle connection or failed; the next query reconnects
+            if self._writer is writer:
+                self._writer = None
+            self.pending.fail(ConnectionError(f"Connection to {self.upstream} closed: {e}"))
+        finally:
+            writer.close()
+
+    async def query(self, query):
+        async with self._connecting:
+            if self._writer is None:
+                await self._connect()
+            writer = self._writer
+        future = self.pending.add(query)
+        try:
+            wire = query.to_wire()
+            writer.write(len(wire).to_bytes(2, 'big') + wire)
+            await writer.drain()
+            return await future
+        finally:
+            self.pending.discard(query)
+
+    def close(self):
+        # A finished loop can no longer close its transport; dropping it lets
+        # garbage collection release the socket
+        if self._writer is not None and not self._loop.is_closed():
+            self._writer.close()
+        self._writer = None
+
+
+class Upstream:
+    def __init__(self, host, port=53, tls=False, server_name=None):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.server_name = server_name
+        self.failures = 0
+        self.down_until = 0.0
+        self.limiter = AIMDLimiter(str(self), DNS_INITIAL_CONCURRENCY, maximum=DNS_MAX_CONCURRENCY)
+        self.reset()
+
+    def __str__(self):
+        return f"{'tls://' if self.tls else ''}{self.host}:{self.port}"
+
+    @classmethod
+    def parse(cls, spec):
+        spec = spec.strip()
+        tls = spec.startswith("tls://")
+        if tls:
+            spec = spec[6:]
+        spec, _, server_name = spec.partition('#')
+        if spec.startswith('['):
+            host, _, port = spec[1:].partition(']:')
+        elif spec.count(':') == 1:
+            host, _, port = spec.partition(':')
+        else:
+            host, port = spec, ""
+        return cls(host.rstrip(']'), int(port) if port else (853 if tls else 53), tls, server_name or None)
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def succeeded(self):
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= MAX_FAILURES:
+            self.down_until = time.monotonic() + UPSTREAM_BACKOFF
+
+    async def _udp_socket(self):
+        async with self._udp_opening:
+            if len(self._udp) < UDP_SOCKETS:
+                self._udp.append(await _UDPSocket.open(self.host, self.port))
+        return min(self._udp, key=lambda s: len(s.pending))
+
+    def _stream_connection(self):
+        if self._stream is None:
+            self._stream = _StreamConnection(self)
+        return self._stream
+
+    async def exchange(self, query, stats):
+        """Send query over UDP (TCP on truncation), or over the TLS connection"""
+        if self.tls:
+            stats["tls"] += 1
+            return await self._stream_connection().query(query)
+        stats["udp"] += 1
+        response = await (await self._udp_socket()).query(query)
+        if response.flags & dns.flags.TC:
+            stats["truncated"] += 1
+            stats["tcp"] += 1
+            response = await self._stream_connection().query(query)
+        return response
+
+    def close(self):
+        for udp in self._udp:
+            udp.close()
+        if self._stream is not None:
+            self._stream.close()
+        self.reset()
+
+    def reset(self):
+        self._udp = []
+        self._udp_opening = asyncio.Lock()
+        self._stream = None
+        self.limiter.reset()
+
+
+class Transport:
+    """Multiplexes queries over pooled sockets to several upstreams, failing over between them"""
+
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+        self.stats = {"queries": 0, "udp": 0, "tcp": 0, "tls": 0, "truncated": 0,
+                      "failovers": 0, "failures": 0}
+        self._loop = None
+
+    def _bind(self):
+        # Sockets belong to one event loop; each asyncio.run() starts afresh
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self.close()
+            self._loop = loop
+
+    def _candidates(self):
+        # Healthy upstreams first, most spare capacity first, ties broken at random
+        return sorted(self.upstreams, key=lambda u: (
+            not u.available, u.limiter.in_flight / u.limiter.limit, random.random()))
+
+    async def _exchange(self, upstream, query, timeout):
+        """One attempt in a slot of upstream's limiter, which learns from its outcome"""
+        started = time.monotonic()
+        seconds = None
+        error = False
+        try:
+            response = await asyncio.wait_for(upstream.exchange(query, self.stats), timeout)
+            # A SERVFAIL or REFUSED is usually about the zone (a lame or broken
+            # delegation), not load, and its latency is that of the zone's servers
+            if response.rcode() in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+                seconds = time.monotonic() - started
+            return response
+        except asyncio.TimeoutError:
+            seconds = time.monotonic() - started
+            error = True
+            raise
+        finally:
+            upstream.limiter.release(seconds, error)
+
+    async def query(self, qname, rdtype, lifetime):
+        """Return the first NOERROR/NXDOMAIN response within lifetime seconds"""
+        self._bind()
+        self.stats["queries"] += 1
+        started = time.monotonic()
+        errors = []
+        attempts = 0
+        rounds = 0
+        # Upstreams that took part, whose limiters say whether a failure may be our own doing
+        tried = set()
+        while True:
+            timed_out = False
+            for upstream in self._candidates():
+                remaining = lifetime - (time.monotonic() - started)
+                if remaining <= 0:
+                    self.stats["failures"] += 1
+                    raise self._failure(dns.resolver.LifetimeTimeout(timeout=lifetime, errors=errors), tried)
+                tried.add(upstream)
+                # Wait here for a slot rather than pile more onto an overloaded upstream
+                try:
+                    await asyncio.wait_for(upstream.limiter.acquire(), remaining)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    errors.append((str(upstream), upstream.tls, upstream.port, "no free slot", None))
+                    continue
+                remaining = lifetime - (time.monotonic() - started)
+                if attempts:
+                    self.stats["failovers"] += 1
+                attempts += 1
+
+                query = dns.message.make_query(qname, rdtype, use_edns=0, payload=EDNS_PAYLOAD)
+                try:
+                    response = await self._exchange(upstream, query, max(min(remaining, ATTEMPT_TIMEOUT), 0))
+                except asyncio.TimeoutError:
+                    upstream.failed()
+                    timed_out = True
+                    errors.append((str(upstream), upstream.tls, upstream.port, "timeout", None))
+                    continue
+                except (OSError, dns.exception.DNSException) as e:
+                    upstream.failed()
+                    errors.append((str(upstream), upstream.tls, upstream.port, str(e) or type(e).__name__, None))
+                    continue
+
+                rcode = response.rcode()
+                if rcode in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+                    upstream.succeeded()
+                    return response, upstream
+                # SERVFAIL, REFUSED and the like: another upstream may do better, but
+                # a SERVFAIL from a lame zone says nothing about this upstream's health
+                if rcode != dns.rcode.SERVFAIL:
+                    upstream.failed()
+                errors.append((str(upstream), upstream.tls, upstream.port, dns.rcode.to_text(rcode), response))
+
+            # Every upstream answered with an error: retrying now would only spin
+            if not timed_out:
+                self.stats["failures"] += 1
+                raise self._failure(dns.resolver.NoNameservers(request=query, errors=errors), tried)
+            # Every upstream timed out: give them a moment before the next round
+            delay = min(backoff(rounds), max(lifetime - (time.monotonic() - started), 0))
+            rounds += 1
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _failure(error, upstreams):
+        error.congestion = any(u.limiter.congested for u in upstreams)
+        return error
+
+    async def resolve(self, qname, rdtype, lifetime):
+        """Same contract as dns.asyncresolver.resolve(): an Answer, NXDOMAIN or NoAnswer"""
+        qname = dns.name.from_text(str(qname))
+        rdtype = dns.rdatatype.RdataType.make(rdtype)
+        response, upstream = await self.query(qname, rdtype, lifetime)
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+        answer = dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response, upstream.host, upstream.port)
+        if answer.rrset is None:
+            raise dns.resolver.NoAnswer(response=response)
+        return answer
+
+    def close(self):
+        for upstream in self.upstreams:
+            upstream.close()
+        self._loop = None
+
+
+def configure(upstreams):
+    """Route queries through upstreams (specs or a comma-separated string); empty disables"""
+    global _transport
+    if _transport is not None:
+        _transport.close()
+    if isinstance(upstreams, str):
+        upstreams = [u for u in upstreams.split(',') if u.strip()]
+    _transport = Transport([Upstream.parse(u) for u in upstreams]) if upstreams else None
+
+
+def get_transport():
+    return _transport
+
+
+if DNS_UPSTREAMS:
+    configure(DNS_UPSTREAMS)
@@ -1,6 +1,50 @@
+import time
+
+
 def parse_domain(domain):
     if domain.startswith(('http://', 'https://')):
         domain = domain.split('//', 1)[1]
 
     domain = domain.split('/')[0].split(':')[0]
     return domain[4:] if domain.startswith('www.') else domain
+
+
+class Deadline:
+    """Time budget shared by every DNS and SMTP operation of one check"""
+
+    def __init__(self, seconds=None):
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    @classmethod
+    def of(cls, value):
+        return value if isinstance(value, cls) else cls(value)
+
+    def remaining(self, cap=None):
+        """Seconds left, limited to cap; None means unbounded"""
+        if self.expires_at is None:
+            return cap
+        left = max(self.expires_at - time.monotonic(), 0)
+        return left if cap is None else min(left, cap)
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+
+def timeout_result(check, **kwargs):
+    return {
+        "status": "timeout",
+        "message": f"Time budget exhausted before the {check} check completed",
+        "partial": True,
+        **kwargs
+    }
+
+
+def inconclusive_result(check, **kwargs):
+    return {
+        "status": "inconclusive",
+        "message": f"The {check} check could not get a reliable answer from overloaded or throttling servers; please retry later",
+        "congestion": True,
+        "partial": True,
+        **kwargs
+    }
@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import asyncio
+import metrics
+import resolver
+import mail_echo_check
+from utils import Deadline
+
+# Upper bound on requests handled at the same time by one worker process
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "16"))
+
+
+async def _dispatch(request, check_domain, deadline):
+    request_type = request.get("type", "check")
+    if request_type == "check":
+        return await check_domain(request["domain"], deadline,
+                                  request.get("timings", False), request.get("force", False),
+                                  request.get("components"))
+    if request_type == "mail_echo":
+        result = await check_domain(request["domain"], deadline, components=("smtp",))
+        return result["smtp"]
+    if request_type == "stats":
+        return {"dns_cache": resolver.cache_stats(), "smtp_cache": mail_echo_check.smtp_cache_stats()}
+    if request_type == "metrics":
+        return {"openmetrics": metrics.render(request.get("labels"))}
+    raise ValueError(f"Unknown request type: {request_type}")
+
+
+def _write(message):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+async def _handle(line, semaphore, check_domain):
+    try:
+        request = json.loads(line)
+    except ValueError:
+        _write({"id": None, "error": "Invalid JSON request"})
+        return
+
+    # The caller's timer started when it wrote the request, so time spent
+    # queued behind other requests comes out of the same budget
+    deadline = Deadline(request.get("deadline"))
+    async with semaphore:
+        try:
+            result = await _dispatch(request, check_domain, deadline)
+            _write({"id": request.get("id"), "result": result})
+        except Exception as e:
+            _write({"id": request.get("id"), "error": str(e) or type(e).__name__})
+
+
+async def serve(check_domain, stdin=None):
+    """Answer newline-delimited JSON requests from stdin until EOF"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdin or sys.stdin)
+
+    semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+    pending = set()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        task = asyncio.create_task(_handle(line, semaphore, check_domain))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await asyncio.gather(*pending)
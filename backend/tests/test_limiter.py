@@ -0,0 +1,159 @@
+"""AIMD concurrency limiter: window judgement, decreases and waiting callers.
+
+    cd backend && python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "scripts"))
+
+import limiter  # noqa: E402
+from limiter import AIMDLimiter, backoff  # noqa: E402
+
+
+async def _window(lim, calls, errors=0, seconds=0.01):
+    """Admit calls at once (saturating the limit), then complete them"""
+    for _ in range(calls):
+        await lim.acquire()
+    for i in range(calls):
+        lim.release(seconds, error=i < errors)
+
+
+def test_healthy_saturated_window_doubles_until_first_decrease():
+    lim = AIMDLimiter("test", 10)
+    asyncio.run(_window(lim, 10))
+    assert lim.limit == 20
+    asyncio.run(_window(lim, 20, errors=5))
+    assert lim.limit == 10
+    asyncio.run(_window(lim, 10))
+    assert lim.limit == 11
+
+
+def test_unsaturated_window_keeps_the_limit():
+    lim = AIMDLimiter("test", 20)
+    for _ in range(2):
+        asyncio.run(_window(lim, 10))
+    assert lim.limit == 20
+
+
+def test_errors_over_threshold_halve_and_mark_congestion():
+    lim = AIMDLimiter("test", 10)
+    asyncio.run(_window(lim, 10, errors=2))
+    assert lim.limit == 20 and not lim.congested
+    asyncio.run(_window(lim, 20, errors=5))
+    assert lim.limit == 10
+    assert lim.congested
+    assert lim.decreases == 1
+
+
+def test_latency_far_above_baseline_halves():
+    lim = AIMDLimiter("test", 10)
+    asyncio.run(_window(lim, 10, seconds=0.1))
+    asyncio.run(_window(lim, 20, seconds=0.5))
+    assert lim.limit == 10
+    assert lim.decreases == 1
+
+
+def test_latency_under_floor_never_counts_as_overload():
+    lim = AIMDLimiter("test", 10)
+    asyncio.run(_window(lim, 10, seconds=0.001))
+    asyncio.run(_window(lim, 20, seconds=limiter.LATENCY_FLOOR / 2))
+    assert lim.decreases == 0
+
+
+def test_calls_admitted_before_a_decrease_do_not_judge_the_new_limit():
+    lim = AIMDLimiter("test", 10)
+
+    async def run():
+        for _ in range(10):
+            await lim.acquire()
+        for _ in range(5):
+            lim.release(1.0, error=True)
+        for _ in range(5):
+            await lim.acquire()
+        # The tenth failure closes the window with five calls still out
+        for _ in range(5):
+            lim.release(1.0, error=True)
+        assert lim.limit == 5 and lim.in_flight == 5
+        for _ in range(5):
+            lim.release(1.0, error=True)
+
+    asyncio.run(run())
+    assert lim.limit == 5
+    assert lim._completions == 0
+
+
+def test_abandoned_calls_free_their_slot_without_judgement():
+    lim = AIMDLimiter("test", 10)
+
+    async def run():
+        for _ in range(10):
+            await lim.acquire()
+        for _ in range(10):
+            lim.release(None)
+
+    asyncio.run(run())
+    assert lim.in_flight == 0
+    assert lim.limit == 10
+
+
+def test_callers_over_the_limit_wait_in_order():
+    lim = AIMDLimiter("test", 1)
+
+    async def run():
+        order = []
+        await lim.acquire()
+
+        async def caller(n):
+            await lim.acquire()
+            order.append(n)
+
+        tasks = [asyncio.ensure_future(caller(n)) for n in range(3)]
+        await asyncio.sleep(0)
+        assert order == [] and lim.in_flight == 1
+        for _ in range(3):
+            lim.release(0.01)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == [0, 1, 2]
+
+
+def test_waiter_cancelled_as_its_slot_arrives_gives_it_back():
+    lim = AIMDLimiter("test", 1)
+
+    async def run():
+        await lim.acquire()
+        waiter = asyncio.ensure_future(lim.acquire())
+        await asyncio.sleep(0)
+        # The slot is handed over, and the waiter cancelled, in the same step
+        lim.release(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(run())
+    assert lim.in_flight == 0
+
+
+def test_waiter_timing_out_leaves_the_queue():
+    lim = AIMDLimiter("test", 1)
+
+    async def run():
+        await lim.acquire()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(lim.acquire(), 0.05)
+
+    asyncio.run(run())
+    assert lim.in_flight == 1
+    assert not lim._waiters
+
+
+@pytest.mark.parametrize("attempt", range(6))
+def test_backoff_stays_within_its_cap(attempt):
+    for _ in range(50):
+        assert 0 <= backoff(attempt, base=0.1, cap=2.0) <= min(2.0, 0.1 * 2 ** attempt)
@@ -0,0 +1,60 @@
+"""SMTP probes shared between checks, against stub DNS and SMTP servers.
+
+    cd backend && python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "scripts"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import resolver  # noqa: E402
+import mail_echo_check  # noqa: E402
+from utils import Deadline  # noqa: E402
+from stubs import Zone, StubDNSServer, StubSMTPServer  # noqa: E402
+
+
+@pytest.fixture(scope="module", autouse=True)
+def stub_dns():
+    zone = Zone()
+    zone.add("silent.bench", 'MX', "10 mx.silent.bench.")
+    zone.add("mx.silent.bench", 'A', "127.0.0.1")
+    server = StubDNSServer(zone).start()
+    resolver.configure(nameservers=[server.host], port=server.port)
+    yield
+    server.stop()
+
+
+@pytest.fixture
+def silent_smtp(monkeypatch):
+    # Accepts connections and never sends a greeting
+    server = StubSMTPServer(delay=3600).start()
+    monkeypatch.setattr(mail_echo_check, "SMTP_PORT", server.port)
+    monkeypatch.setattr(mail_echo_check, "SMTP_DEADLINE", 0.5)
+    mail_echo_check.clear_smtp_cache()
+    resolver.clear_cache()
+    yield server
+    mail_echo_check.clear_smtp_cache()
+    server.stop()
+
+
+def test_silent_server_probe_ends_after_callers_give_up(silent_smtp):
+    async def run():
+        first = await mail_echo_check.check_mail_echo_with_smtp_async("silent.bench", Deadline(0.2))
+        assert first["status"] == "timeout"
+        # The shared conversation outlives its caller, but not its own bound
+        assert len(mail_echo_check._probes) == 1
+        await asyncio.sleep(0.6)
+        assert len(mail_echo_check._probes) == 0
+        assert mail_echo_check._limiter_for("127.0.0.1").in_flight == 0
+        return await mail_echo_check.check_mail_echo_with_smtp_async("silent.bench", Deadline(0.2))
+
+    second = asyncio.run(run())
+    assert second["status"] == "warning"
+    assert second["hosts"][0].get("cached")
+    assert "No SMTP response" in second["hosts"][0]["error"]
+    assert silent_smtp.sessions == 1
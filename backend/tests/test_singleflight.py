@@ -0,0 +1,136 @@
+"""SingleFlight: concurrent callers share one call, which outlives callers that give up.
+
+    cd backend && python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "scripts"))
+
+from singleflight import SingleFlight  # noqa: E402
+
+
+class Call:
+    """A factory that counts its calls and finishes when released"""
+
+    def __init__(self, result="answer", error=None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_callers_share_one_call():
+    flights = SingleFlight("test")
+    call = Call()
+
+    async def run():
+        call.release = asyncio.Event()
+        callers = [asyncio.ensure_future(flights.do("key", call)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert len(flights) == 1
+        call.release.set()
+        return await asyncio.gather(*callers)
+
+    assert asyncio.run(run()) == ["answer"] * 5
+    assert call.calls == 1
+    assert len(flights) == 0
+
+
+def test_distinct_keys_and_later_calls_run_again():
+    flights = SingleFlight("test")
+    call = Call()
+
+    async def run():
+        call.release = asyncio.Event()
+        call.release.set()
+        await asyncio.gather(flights.do("a", call), flights.do("b", call))
+        await flights.do("a", call)
+
+    asyncio.run(run())
+    assert call.calls == 3
+
+
+def test_a_caller_giving_up_does_not_cancel_the_others():
+    flights = SingleFlight("test")
+    call = Call()
+
+    async def run():
+        call.release = asyncio.Event()
+        impatient = asyncio.ensure_future(asyncio.wait_for(flights.do("key", call), 0.01))
+        patient = asyncio.ensure_future(flights.do("key", call))
+        with pytest.raises(asyncio.TimeoutError):
+            await impatient
+        call.release.set()
+        return await patient
+
+    assert asyncio.run(run()) == "answer"
+    assert call.calls == 1
+
+
+def test_the_call_outlives_every_caller():
+    flights = SingleFlight("test")
+    call = Call()
+
+    async def run():
+        call.release = asyncio.Event()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(flights.do("key", call), 0.01)
+        # Still running with nobody waiting; a new caller joins it
+        assert len(flights) == 1
+        joined = asyncio.ensure_future(flights.do("key", call))
+        await asyncio.sleep(0)
+        call.release.set()
+        result = await joined
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "answer"
+    assert call.calls == 1
+    assert len(flights) == 0
+
+
+def test_errors_reach_every_caller_and_end_the_flight():
+    flights = SingleFlight("test")
+    call = Call(error=ValueError("boom"))
+
+    async def run():
+        call.release = asyncio.Event()
+        callers = [asyncio.ensure_future(flights.do("key", call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        call.release.set()
+        return await asyncio.gather(*callers, return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert call.calls == 1
+    assert len(flights) == 0
+
+
+def test_an_abandoned_failure_is_not_reported_unretrieved():
+    flights = SingleFlight("test")
+    call = Call(error=ValueError("boom"))
+    unhandled = []
+
+    async def run():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        call.release = asyncio.Event()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(flights.do("key", call), 0.01)
+        call.release.set()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert len(flights) == 0
+    assert not unhandled
@@ -0,0 +1,118 @@
+"""check_host() cases from RFC 7208, evaluated against the stub DNS server.
+
+    cd backend && python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "scripts"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import resolver  # noqa: E402
+import spf_eval  # noqa: E402
+from spf_graph import graph  # noqa: E402
+from stubs import Zone, StubDNSServer  # noqa: E402
+
+RECORDS = [
+    # include: pass matches with the include's qualifier, anything else falls through
+    ("plain.bench", 'TXT', '"v=spf1 include:child-pass.bench -all"'),
+    ("child-pass.bench", 'TXT', '"v=spf1 ip4:192.0.2.0/24 -all"'),
+    ("soft.bench", 'TXT', '"v=spf1 ~include:child-pass.bench ip4:198.51.100.1 -all"'),
+    # The included default applies only where the child's own terms said nothing
+    ("a.bench", 'TXT', '"v=spf1 include:child.bench -all"'),
+    ("child.bench", 'TXT', '"v=spf1 -ip4:1.2.3.4 +all"'),
+    ("b.bench", 'TXT', '"v=spf1 include:err.bench ip4:5.5.5.5 -all"'),
+    ("err.bench", 'TXT', '"v=spf1 -ip4:5.5.5.5 include:missing.bench"'),
+    ("noinclude.bench", 'TXT', '"v=spf1 include:nospf.bench -all"'),
+    ("nospf.bench", 'TXT', '"not spf"'),
+    ("slow.bench", 'TXT', '"v=spf1 include:dropped.bench -all"'),
+    ("slow-a.bench", 'TXT', '"v=spf1 include:child-a.bench -all"'),
+    ("child-a.bench", 'TXT', '"v=spf1 a:dropped.bench -all"'),
+    # Earlier terms win over later ones, including over an include's ranges
+    ("order.bench", 'TXT', '"v=spf1 -ip4:192.0.2.7 include:child-pass.bench ?all"'),
+    # redirect= applies when no term matched, and only then
+    ("redir.bench", 'TXT', '"v=spf1 ip4:203.0.113.1 redirect=target.bench"'),
+    ("target.bench", 'TXT', '"v=spf1 ip4:203.0.113.2 ~all"'),
+    ("redir-all.bench", 'TXT', '"v=spf1 -all redirect=target.bench"'),
+    ("redir-missing.bench", 'TXT', '"v=spf1 redirect=nospf.bench"'),
+    # a, mx and exists
+    ("hosts.bench", 'TXT', '"v=spf1 a mx -all"'),
+    ("hosts.bench", 'A', "192.0.2.10"),
+    ("hosts.bench", 'MX', "10 mail.hosts.bench."),
+    ("mail.hosts.bench", 'A', "192.0.2.20"),
+    ("mail.hosts.bench", 'AAAA', "2001:db8::20"),
+    ("exists.bench", 'TXT', '"v=spf1 exists:v4.bench -all"'),
+    ("v4.bench", 'A', "127.0.0.2"),
+    ("exists6.bench", 'TXT', '"v=spf1 exists:v6only.bench -all"'),
+    ("v6only.bench", 'AAAA', "2001:db8::1"),
+    # Two records, or an include loop, are permanent errors
+    ("twice.bench", 'TXT', '"v=spf1 -all"', '"v=spf1 +all"'),
+    ("loop.bench", 'TXT', '"v=spf1 include:loop2.bench -all"'),
+    ("loop2.bench", 'TXT', '"v=spf1 include:loop.bench -all"'),
+]
+
+CASES = [
+    ("plain.bench", "192.0.2.1", "pass"),
+    ("plain.bench", "198.51.100.1", "fail"),
+    ("soft.bench", "192.0.2.1", "softfail"),
+    ("soft.bench", "198.51.100.1", "pass"),
+    ("a.bench", "1.2.3.4", "fail"),
+    ("a.bench", "9.9.9.9", "pass"),
+    ("b.bench", "5.5.5.5", "pass"),
+    ("b.bench", "6.6.6.6", "permerror"),
+    ("noinclude.bench", "192.0.2.1", "permerror"),
+    ("slow.bench", "192.0.2.1", "temperror"),
+    ("slow-a.bench", "192.0.2.1", "temperror"),
+    ("order.bench", "192.0.2.7", "fail"),
+    ("order.bench", "192.0.2.8", "pass"),
+    ("order.bench", "10.0.0.1", "neutral"),
+    ("redir.bench", "203.0.113.1", "pass"),
+    ("redir.bench", "203.0.113.2", "pass"),
+    ("redir.bench", "203.0.113.3", "softfail"),
+    ("redir-all.bench", "203.0.113.2", "fail"),
+    ("redir-missing.bench", "192.0.2.1", "permerror"),
+    ("hosts.bench", "192.0.2.10", "pass"),
+    ("hosts.bench", "192.0.2.20", "pass"),
+    ("hosts.bench", "2001:db8::20", "pass"),
+    ("hosts.bench", "192.0.2.30", "fail"),
+    ("exists.bench", "10.0.0.1", "pass"),
+    ("exists6.bench", "10.0.0.1", "fail"),
+    ("twice.bench", "10.0.0.1", "permerror"),
+    ("loop.bench", "10.0.0.1", "permerror"),
+    ("nospf.bench", "10.0.0.1", "none"),
+]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def stub_dns():
+    zone = Zone()
+    for name, rdtype, *rdatas in RECORDS:
+        zone.add(name, rdtype, *rdatas)
+    zone.blackhole("dropped.bench")
+    server = StubDNSServer(zone).start()
+    resolver.configure(nameservers=[server.host], port=server.port)
+    lifetime = resolver.DNS_LIFETIME
+    resolver.DNS_LIFETIME = 0.5
+    yield
+    resolver.DNS_LIFETIME = lifetime
+    server.stop()
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    resolver.clear_cache()
+    graph.clear()
+    spf_eval._compiled.clear()
+
+
+@pytest.mark.parametrize("domain, ip, expected", CASES)
+def test_check_host(domain, ip, expected):
+    assert spf_eval.check_host(ip, domain) == expected
+
+
+def test_temperror_is_not_cached():
+    assert spf_eval.check_host("192.0.2.1", "slow-a.bench") == "temperror"
+    assert spf_eval._compiled.get("slow-a.bench") is None
@@ -0,0 +1,81 @@
+"""SPF include subtrees shared between concurrent walks, against the stub DNS server.
+
+    cd backend && python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "scripts"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import resolver  # noqa: E402
+from spf_graph import SPFGraph  # noqa: E402
+from stubs import Zone, StubDNSServer  # noqa: E402
+
+RECORDS = [
+    ("one.bench", 'TXT', '"v=spf1 include:_spf.provider.bench -all"'),
+    ("two.bench", 'TXT', '"v=spf1 include:_spf.provider.bench -all"'),
+    ("_spf.provider.bench", 'TXT', '"v=spf1 include:_netblocks.provider.bench ~all"'),
+    ("_netblocks.provider.bench", 'TXT', '"v=spf1 ip4:192.0.2.0/24 ~all"'),
+    # An include loop entered from both ends at once
+    ("loop-a.bench", 'TXT', '"v=spf1 include:a.loop.bench -all"'),
+    ("loop-b.bench", 'TXT', '"v=spf1 include:b.loop.bench -all"'),
+    ("a.loop.bench", 'TXT', '"v=spf1 include:b.loop.bench -all"'),
+    ("b.loop.bench", 'TXT', '"v=spf1 include:a.loop.bench -all"'),
+]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def stub_dns():
+    zone = Zone()
+    for name, rdtype, *rdatas in RECORDS:
+        zone.add(name, rdtype, *rdatas)
+    zone.delay("_spf.provider.bench", 0.1)
+    zone.delay("a.loop.bench", 0.1)
+    zone.delay("b.loop.bench", 0.1)
+    server = StubDNSServer(zone).start()
+    resolver.configure(nameservers=[server.host], port=server.port)
+    yield
+    server.stop()
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    resolver.clear_cache()
+    graph = SPFGraph()
+    builds = []
+    build = graph._build_subtree
+
+    async def counted(key, *args):
+        builds.append(key)
+        return await build(key, *args)
+
+    monkeypatch.setattr(graph, "_build_subtree", counted)
+    graph.builds = builds
+    return graph
+
+
+def _analyze_all(graph, roots):
+    # Each root's own record, as the SPF check passes it in
+    records = {name: rdatas[0].strip('"') for name, _, *rdatas in RECORDS}
+
+    async def run():
+        return await asyncio.gather(*(graph.analyze(records[root], root) for root in roots))
+    return asyncio.run(asyncio.wait_for(run(), 5))
+
+
+def test_concurrent_domains_share_an_include_walk(graph):
+    (_, one, complete_one), (_, two, complete_two) = _analyze_all(graph, ["one.bench", "two.bench"])
+    assert (one, two) == (2, 2)
+    assert complete_one and complete_two
+    assert graph.builds.count("_spf.provider.bench") == 1
+    assert graph.builds.count("_netblocks.provider.bench") == 1
+
+
+def test_loop_entered_from_both_ends_does_not_hang(graph):
+    results = _analyze_all(graph, ["loop-a.bench", "loop-b.bench"])
+    assert not any(complete for _, _, complete in results)
@@ -0,0 +1,117 @@
+"""Pooled DNS transport: failover, TCP fallback and limiter feedback, against stub servers.
+
+    cd backend && python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+
+import dns.resolver
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "scripts"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import transport  # noqa: E402
+from transport import Transport, Upstream  # noqa: E402
+from stubs import Zone, StubDNSServer  # noqa: E402
+
+# Too large for the advertised UDP payload, so it only arrives over TCP
+LARGE_TXT = ['"%d%s"' % (i, "x" * 250) for i in range(8)]
+
+
+@pytest.fixture(scope="module")
+def zone():
+    zone = Zone()
+    zone.add("host.bench", 'A', "192.0.2.1")
+    zone.add("large.bench", 'TXT', *LARGE_TXT)
+    zone.servfail("lame.bench")
+    zone.blackhole("dropped.bench")
+    return zone
+
+
+@pytest.fixture(scope="module")
+def server(zone):
+    server = StubDNSServer(zone).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope="module")
+def dead_server():
+    # Drops every query, as an unreachable upstream would
+    zone = Zone()
+    zone.blackhole("bench")
+    server = StubDNSServer(zone).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(autouse=True)
+def short_timeouts(monkeypatch, server):
+    monkeypatch.setattr(transport, "ATTEMPT_TIMEOUT", 0.2)
+    server.reset_counters()
+
+
+def _upstream(server):
+    return Upstream(server.host, server.port)
+
+
+def _resolve_all(upstreams, names, rdtype='A', lifetime=2.0):
+    async def run():
+        return await asyncio.gather(*(upstreams.resolve(name, rdtype, lifetime) for name in names),
+                                    return_exceptions=True)
+    try:
+        return asyncio.run(run())
+    finally:
+        upstreams.close()
+
+
+def test_fails_over_from_an_unresponsive_upstream(server, dead_server):
+    dead, live = _upstream(dead_server), _upstream(server)
+    upstreams = Transport([dead, live])
+    # Ties between equally loaded upstreams break at random: enough queries
+    # that the dead one is all but certain to be tried first MAX_FAILURES times
+    answers = _resolve_all(upstreams, ["host.bench"] * 30)
+    assert all(str(a[0]) == "192.0.2.1" for a in answers)
+    assert upstreams.stats["failovers"] > 0
+    # Once marked down, the dead upstream is tried last
+    assert not dead.available
+    assert upstreams._candidates()[0] is live
+
+
+def test_truncated_answers_move_to_one_pipelined_tcp_connection(server):
+    upstreams = Transport([_upstream(server)])
+    answers = _resolve_all(upstreams, ["large.bench"] * 5, 'TXT')
+    assert all(len(a.rrset) == len(LARGE_TXT) for a in answers)
+    assert upstreams.stats["truncated"] == 5
+    assert upstreams.stats["tcp"] == 5
+    assert server.tcp_connections == 1
+
+
+def test_nxdomain_and_nodata_follow_the_resolver_contract(server):
+    upstreams = Transport([_upstream(server)])
+    missing, nodata = _resolve_all(upstreams, ["missing.bench", "host.bench"], 'MX')
+    assert isinstance(missing, dns.resolver.NXDOMAIN)
+    assert isinstance(nodata, dns.resolver.NoAnswer)
+
+
+def test_servfail_is_the_zones_answer_not_upstream_overload(server):
+    upstream = _upstream(server)
+    upstreams = Transport([upstream])
+    errors = _resolve_all(upstreams, ["lame.bench"] * 100)
+    assert all(isinstance(e, dns.resolver.NoNameservers) for e in errors)
+    assert not any(e.congestion for e in errors)
+    assert upstream.limiter.decreases == 0
+    assert upstream.available
+
+
+def test_timeouts_cut_the_limit_and_tag_later_failures(server):
+    upstream = _upstream(server)
+    upstreams = Transport([upstream])
+    errors = _resolve_all(upstreams, ["dropped.bench"] * 40, lifetime=0.3)
+    assert all(isinstance(e, dns.resolver.LifetimeTimeout) for e in errors)
+    assert upstream.limiter.decreases >= 1
+    assert upstream.limiter.limit < transport.DNS_INITIAL_CONCURRENCY
+    assert any(e.congestion for e in errors)
@@ -61,11 +61,21 @@ export interface DmarcResult {
   feedback?: Feedback;
 }
 
+export interface MxHostProbe {
+  host: string;
+  preference: number;
+  address?: string;
+  reachable: boolean;
+  latency_ms?: number;
+  error?: string;
+}
+
 export interface MailEchoResult {
   status: string;
   message: string;
   echo?: string;
   mx_host?: string;
+  hosts?: MxHostProbe[];
   feedback?: Feedback;
 }
 